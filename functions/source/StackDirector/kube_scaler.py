@@ -0,0 +1,248 @@
+import base64
+import http.client
+import json
+import logging
+import os
+import queue
+import ssl
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ruamel import yaml
+
+log = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT = 10
+CONCURRENCY = 8
+# How long to wait for an operator pod to go away before the workloads it manages
+# can be scaled down without the operator scaling them back up
+WAIT_TIMEOUT = 60
+POLL_INTERVAL = 2
+
+MERGE_PATCH = 'application/merge-patch+json'
+
+
+class KubeError(Exception):
+    def __init__(self, method, path, status, body):
+        super(KubeError, self).__init__("{} {} returned {}: {}".format(method, path, status, body[:200]))
+        self.status = status
+
+
+class ConsoleMissing(Exception):
+    # The only failed step that means the cluster itself is broken
+    pass
+
+
+def named(items, name):
+    # Kubeconfig entries are lists of {"name": ..., <kind>: {...}}
+    for item in items or []:
+        if item.get('name') == name:
+            return item
+    return (items or [{}])[0]
+
+
+class KubeClient(object):
+    """
+    Talks to the cluster API with the credentials of a kubeconfig, reusing a small
+    pool of keep-alive connections across threads.
+    """
+    def __init__(self, kubeconfig, pool_size=CONCURRENCY, timeout=REQUEST_TIMEOUT):
+        config = yaml.safe_load(kubeconfig)
+        context = named(config.get('contexts'), config.get('current-context')).get('context', {})
+        cluster = named(config.get('clusters'), context.get('cluster')).get('cluster', {})
+        user = named(config.get('users'), context.get('user')).get('user', {})
+        server = urllib.parse.urlsplit(cluster['server'])
+        self.https = server.scheme == 'https'
+        self.host = server.hostname
+        self.port = server.port or (443 if self.https else 80)
+        self.timeout = timeout
+        self.headers = {'Accept': 'application/json'}
+        if user.get('token'):
+            self.headers['Authorization'] = 'Bearer ' + user['token']
+        self.ssl_context = self.build_ssl_context(cluster, user) if self.https else None
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+
+    @staticmethod
+    def build_ssl_context(cluster, user):
+        if cluster.get('insecure-skip-tls-verify'):
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        elif cluster.get('certificate-authority-data'):
+            context = ssl.create_default_context(
+                cadata=base64.b64decode(cluster['certificate-authority-data']).decode())
+        else:
+            context = ssl.create_default_context(cafile=cluster.get('certificate-authority'))
+        if user.get('client-certificate-data'):
+            # load_cert_chain only reads files, the key material lives on disk just
+            # long enough to be loaded
+            with tempfile.NamedTemporaryFile(suffix='.pem', delete=False) as file:
+                file.write(base64.b64decode(user['client-certificate-data']))
+                file.write(b'\n')
+                file.write(base64.b64decode(user['client-key-data']))
+            try:
+                context.load_cert_chain(file.name)
+            finally:
+                os.remove(file.name)
+        return context
+
+    def connection(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            if self.https:
+                return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                                   context=self.ssl_context)
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def release(self, conn):
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method, path, body=None, content_type='application/json', missing_ok=False):
+        headers = dict(self.headers)
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = content_type
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # A pooled connection may have been closed by the server, retry once
+                # on a fresh one
+                if attempt:
+                    raise
+                continue
+            self.release(conn)
+            break
+        if response.status == 404 and missing_ok:
+            return None
+        if response.status >= 400:
+            raise KubeError(method, path, response.status, data.decode('utf-8', 'replace'))
+        return json.loads(data) if data else {}
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def scale(client, namespace, kind, name, replicas):
+    client.request('PATCH', '/apis/apps/v1/namespaces/{}/{}/{}/scale'.format(namespace, kind, name),
+                   {"spec": {"replicas": replicas}}, MERGE_PATCH)
+
+
+def scale_all(client, namespace, kind, replicas):
+    # Equivalent of "oc scale --all", workloads already at the target are left alone
+    items = client.request('GET', '/apis/apps/v1/namespaces/{}/{}'.format(namespace, kind))['items']
+    for item in items:
+        if item['spec'].get('replicas') != replicas:
+            scale(client, namespace, kind, item['metadata']['name'], replicas)
+
+
+def list_pods(client, namespace, selector):
+    return client.request('GET', '/api/v1/namespaces/{}/pods?labelSelector={}'.format(
+        namespace, urllib.parse.quote(selector)))['items']
+
+
+def delete_pods(client, namespace, selector):
+    client.request('DELETE', '/api/v1/namespaces/{}/pods?labelSelector={}'.format(
+        namespace, urllib.parse.quote(selector)))
+
+
+def wait_for_pods_gone(client, namespace, selector, wait_timeout):
+    deadline = time.time() + wait_timeout
+    while list_pods(client, namespace, selector):
+        if time.time() > deadline:
+            raise Exception("{} pods in {} still running after {:.0f}s".format(selector, namespace, wait_timeout))
+        time.sleep(POLL_INTERVAL)
+
+
+def scale_cluster_version(client, wait_timeout):
+    # A running cluster-version operator puts back the replicas of every operator it
+    # manages, so it has to be gone before any other step runs
+    scale_all(client, 'openshift-cluster-version', 'deployments', 0)
+    wait_for_pods_gone(client, 'openshift-cluster-version', 'k8s-app=cluster-version-operator', wait_timeout)
+
+
+def scale_monitoring(client, wait_timeout):
+    scale_all(client, 'openshift-monitoring', 'deployments', 0)
+    wait_for_pods_gone(client, 'openshift-monitoring', 'app=cluster-monitoring-operator', wait_timeout)
+    scale_all(client, 'openshift-monitoring', 'statefulsets', 0)
+
+
+def scale_console(client):
+    if client.request('GET', '/api/v1/namespaces/openshift-console', missing_ok=True) is None:
+        raise ConsoleMissing("openshift-console namespace not found")
+    scale(client, 'openshift-console', 'deployments', 'console', 1)
+    scale(client, 'openshift-console', 'deployments', 'downloads', 1)
+
+
+def patch_ingress(client):
+    client.request('PATCH', '/apis/operator.openshift.io/v1/namespaces/openshift-ingress-operator/'
+                            'ingresscontrollers/default', {"spec": {"replicas": 1}}, MERGE_PATCH)
+
+
+def patch_registry(client):
+    # Default route and ephemeral storage for the internal registry
+    client.request('PATCH', '/apis/imageregistry.operator.openshift.io/v1/configs/cluster',
+                   {"spec": {"defaultRoute": True, "storage": {"emptyDir": {}},
+                             "managementState": "Managed"}}, MERGE_PATCH)
+
+
+def delete_metrics_apiservice(client):
+    # The apiservice blocks namespace deletion forever once monitoring is scaled down
+    client.request('DELETE', '/apis/apiregistration.k8s.io/v1/apiservices/v1beta1.metrics.k8s.io',
+                   missing_ok=True)
+
+
+def steps(client, wait_timeout):
+    # Independent steps, each one is sequential on its own. They all run once the
+    # cluster-version operator is gone.
+    yield "monitoring", scale_monitoring, client, wait_timeout
+    for namespace in ('openshift-kube-apiserver', 'openshift-kube-scheduler',
+                      'openshift-kube-controller-manager'):
+        yield namespace + " pods", delete_pods, client, namespace, 'app in (installer, pruner)'
+    for namespace in ('openshift-machine-api', 'openshift-machine-config-operator',
+                      'openshift-insights', 'openshift-cloud-credential-operator'):
+        yield namespace, scale_all, client, namespace, 'deployments', 0
+    yield "ingress", patch_ingress, client
+    yield "console", scale_console, client
+    yield "registry", patch_registry, client
+    yield "metrics apiservice", delete_metrics_apiservice, client
+
+
+def scale_down(kubeconfig, concurrency=CONCURRENCY, wait_timeout=WAIT_TIMEOUT):
+    """
+    Shrinks a freshly installed cluster to the workshop footprint, see the README.
+    The cluster-version operator is scaled down first, then every other step runs
+    even when another one fails. Returns a map of the failed step names to their
+    errors.
+    """
+    client = KubeClient(kubeconfig, pool_size=concurrency)
+    failed = {}
+    try:
+        try:
+            scale_cluster_version(client, wait_timeout)
+        except Exception as e:
+            # Anything scaled now would be scaled back up by the operator
+            return {"cluster-version": e}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(*step[1:]): step[0] for step in steps(client, wait_timeout)}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed[futures[future]] = e
+    finally:
+        client.close()
+    return failed
@@ -1,34 +1,186 @@
+# ruamel.yaml, jinja2, tarfile, subprocess, multiprocessing and kube_scaler are
+# imported by the functions that use them. A Validate run needs none of them until a
+# cluster is ready to be scaled down or a student's status changes.
 import urllib.request
 import urllib.error
-from ruamel import yaml
 import cfnresponse
+import telemetry
 import os
 import logging
 import sys
+import socket
+import ssl
 import hashlib
-import tarfile
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
-import subprocess
-import jinja2
+import signal
 import time
 import json
+import copy
+import random
+import math
+import threading
+import uuid
+import bisect
+import ipaddress
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
 
 log = logging.getLogger(__name__)
 
-def stack_exists(cf_client, stack_name):
-    stack_status_codes = ['CREATE_COMPLETE',
-                          'CREATE_IN_PROGRESS',
-                          'UPDATE_COMPLETE',
-                          'UPDATE_ROLLBACK_COMPLETE',
-                          'ROLLBACK_COMPLETE',
-                          'CREATE_FAILED',
-                          'DELETE_IN_PROGRESS',
-                          'DELETE_FAILED']
-    for s in stacks_by_status(cf_client, stack_status_codes):
-        if s.get('StackName', '') == stack_name:
-            return s
-    return None
+IGNITION_FILES = ['auth/kubeconfig', 'auth/kubeadmin-password', 'master.ign', 'bootstrap.ign']
+IGNITION_CACHE_FILE = 'ignition-cache.json'
+# Ignition assets are synced by content: a single listing of the student prefix gives
+# the ETag of every stored file and only files whose MD5 differs are uploaded
+IGNITION_SYNC_CONCURRENCY = 4
+# The bootstrap certificates embedded in the ignition files are only valid for 24 hours
+IGNITION_CACHE_MAX_AGE = 12 * 60 * 60
+KUBEADMIN_PASSWORD_FILE = 'auth/kubeadmin-password'
+
+s3_request_count = 0
+s3_request_lock = threading.Lock()
+
+# Clients are created once and reused by every worker thread and warm invocation
+CLIENT_CONFIG = Config(max_pool_connections=50,
+                       connect_timeout=10,
+                       read_timeout=60,
+                       retries={'max_attempts': 10, 'mode': 'standard'})
+clients = {}
+clients_lock = threading.Lock()
+# Conditional request headers for the put_object calls of the current thread
+write_conditions = threading.local()
+account_id = None
+
+STACK_STATUS_CODES = ['CREATE_COMPLETE',
+                      'CREATE_IN_PROGRESS',
+                      'UPDATE_COMPLETE',
+                      'UPDATE_ROLLBACK_COMPLETE',
+                      'ROLLBACK_COMPLETE',
+                      'CREATE_FAILED',
+                      'DELETE_IN_PROGRESS',
+                      'DELETE_FAILED']
+stack_cache = None
+
+# Per deployment student state document in the AuthBucket
+STATE_FILE = 'state.json'
+
+# Every student's clusterNetwork and serviceNetwork, allocated once and reused on
+# rebuilds. Networks are blocks of the size in install-config.yaml, taken from the
+# private ranges starting at the network install-config.yaml names.
+NETWORK_PLAN_FILE = 'network-plan.json'
+PRIVATE_NETWORKS = [ipaddress.ip_network(cidr) for cidr in ('10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16')]
+# What openshift-install uses when install-config.yaml sets no machineNetwork
+DEFAULT_MACHINE_NETWORK = '10.0.0.0/16'
+STATE_WRITE_ATTEMPTS = 10
+state_store = None
+
+# Success and failure states for each waiter used with wait_for_stack_state
+WAITER_STATES = {
+    'stack_delete_complete': (['DELETE_COMPLETE'], ['DELETE_FAILED'])
+}
+WAITER_MIN_DELAY = 5
+WAITER_MAX_DELAY = 60
+# Time left for cleanup and a hand off before the Lambda times out
+WAITER_DEADLINE_MARGIN = 60
+# CloudFormation waits an hour for a custom resource to answer. Every invocation of a
+# request, continuations and shard workers included, stops this long after the first
+# one started, so the last of them answers in time.
+REQUEST_DEADLINE = 55 * 60
+# A Validate run holds this lease in the state document, runs fired while it is held
+# are skipped instead of probing, scaling and rebuilding the same students. It is
+# held for at most the Lambda timeout.
+VALIDATE_LEASE = 'validate'
+VALIDATE_LEASE_TIME = 15 * 60
+# Validate schedule: a fresh OCP 4 install is not probed before VALIDATE_INSTALL_TIME,
+# clusters about to answer are checked every VALIDATE_MIN_INTERVAL and the ones that
+# still have no DNS record back off up to VALIDATE_MAX_INTERVAL.
+VALIDATE_INSTALL_TIME = 30 * 60
+VALIDATE_MIN_INTERVAL = 5 * 60
+VALIDATE_MAX_INTERVAL = 60 * 60
+# Validate runs that retry failed scaling steps before the cluster is accepted as it
+# is, like the old scale script that ignored failed steps
+SCALE_MAX_ATTEMPTS = 3
+# Shard workers report their result under SHARD_PREFIX/<RequestId>/, polled with
+# one listing every SHARD_POLL_DELAY seconds
+SHARD_PREFIX = '.shards'
+SHARD_POLL_DELAY = 2
+# Create plus rebuild attempts per student before it is marked failed
+REBUILD_MAX_ATTEMPTS = 3
+# Delete attempts within a single rebuild before the stack is reported failed
+REBUILD_DELETE_ATTEMPTS = 3
+REBUILD_CONCURRENCY = 20
+# Lambda time reserved for a student before it is started, raised to the slowest
+# student seen so far
+CREATE_STUDENT_BUDGET = 180
+
+# Warm invocations reuse the environment settings, the parsed install-config.yaml and
+# the compiled templates of the previous ones
+config = None
+base_install_config = None
+template_env = None
+templates = {}
+student_fragments = {}
+
+# Binaries extracted from the OpenShift packages are cached under this prefix
+ARTIFACT_CACHE_PREFIX = '.artifacts'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+
+# Connect/read timeout and parallelism for the cluster API health probes
+PROBE_TIMEOUT = 10
+PROBE_CONCURRENCY = 20
+
+# Keys per delete_objects request (the API maximum), concurrent requests and listing
+# passes allowed before a bucket that keeps refilling is reported as failed
+S3_DELETE_BATCH = 1000
+S3_DELETE_CONCURRENCY = 8
+S3_DELETE_PASSES = 3
+
+# Subprocesses get at most PROCESS_TIMEOUT seconds and never outlive the invocation.
+# Only PROCESS_CONCURRENCY of them run at once whatever the size of the worker pools,
+# and the last PROCESS_OUTPUT_LINES lines of output are kept for the error report.
+PROCESS_TIMEOUT = 600
+PROCESS_CONCURRENCY = 4
+PROCESS_OUTPUT_LINES = 50
+PROCESS_LINE_LIMIT = 4096
+process_slots = threading.BoundedSemaphore(PROCESS_CONCURRENCY)
+process_deadline = None
+request_deadline = None
+
+THROTTLING_ERRORS = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException']
+SUBMIT_BASE_DELAY = 2
+SUBMIT_MAX_DELAY = 60
+SUBMIT_MAX_ATTEMPTS = 8
+# Stays below CloudFormation's per account CreateStack request limit
+CREATE_STACK_RATE = 2
+
+def get_client(service):
+    client = clients.get(service)
+    if client is None:
+        with clients_lock:
+            client = clients.get(service)
+            if client is None:
+                client = boto3.session.Session().client(service, config=CLIENT_CONFIG)
+                if service == 's3':
+                    # Every S3 call is counted here, paginated listings and the parts of
+                    # a multipart upload included
+                    client.meta.events.register('before-call.s3', count_s3_request)
+                    client.meta.events.register('before-call.s3.PutObject', add_write_conditions)
+                clients[service] = client
+    return client
+
+def add_write_conditions(params, **kwargs):
+    # The boto3 bundled with the python3.7 runtime predates the IfMatch and IfNoneMatch
+    # parameters of put_object, S3 honours the headers regardless of the SDK version
+    params['headers'].update(getattr(write_conditions, 'headers', {}))
+
+def get_account_id():
+    global account_id
+    if account_id is None:
+        account_id = get_client('sts').get_caller_identity().get('Account')
+    return account_id
 
 def stacks_by_status(cf_client, status_include_filter):
     """
@@ -40,6 +192,218 @@ def stacks_by_status(cf_client, status_include_filter):
         for s in page.get('StackSummaries', []):
             yield s
 
+class StackStatusCache(object):
+    """
+    Name to stack summary map built from a single paginated ``list_stacks`` scan.
+    Stacks changed by this invocation are refreshed with ``describe_stacks``.
+    """
+    def __init__(self, cf_client):
+        self.cf_client = cf_client
+        self.stacks = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @telemetry.timed('cloudformation.list_stacks')
+    def scan(self):
+        stacks = {}
+        for s in stacks_by_status(self.cf_client, STACK_STATUS_CODES):
+            stacks[s['StackName']] = s
+        self.stacks = stacks
+
+    def get(self, stack_name):
+        with self.lock:
+            if self.stacks is None:
+                self.misses += 1
+                self.scan()
+            else:
+                self.hits += 1
+            return self.stacks.get(stack_name)
+
+    @telemetry.timed('cloudformation.describe_stacks')
+    def describe(self, stack_name):
+        with self.lock:
+            self.misses += 1
+        try:
+            stack = self.cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+        except ClientError as e:
+            if 'does not exist' not in str(e):
+                raise
+            stack = None
+        self.update(stack_name, stack)
+        return stack
+
+    def update(self, stack_name, summary):
+        with self.lock:
+            if self.stacks is None:
+                return
+            if summary is None or summary.get('StackStatus') == 'DELETE_COMPLETE':
+                self.stacks.pop(stack_name, None)
+            else:
+                self.stacks[stack_name] = summary
+
+def get_stack_cache():
+    global stack_cache
+    if stack_cache is None:
+        stack_cache = StackStatusCache(get_client('cloudformation'))
+    return stack_cache
+
+def reset_stack_cache():
+    global stack_cache
+    stack_cache = None
+
+class StateStore(object):
+    """
+    Lifecycle state of every student in a deployment, kept in a single S3 document.
+
+    The document is read with one GET and every change is written with an S3
+    conditional PUT (If-Match on the ETag that was read, If-None-Match when creating),
+    so concurrent invocations cannot overwrite each other's updates; a conflicting
+    write reloads and reapplies.
+    """
+    def __init__(self, s3_bucket):
+        self.s3_bucket = s3_bucket
+        self.students = None
+        self.leases = {}
+        self.etag = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.students is None:
+                if not self.read():
+                    self.migrate()
+            return self.students
+
+    @telemetry.timed('state.read')
+    def read(self):
+        try:
+            response = get_client('s3').get_object(Bucket=self.s3_bucket, Key=STATE_FILE)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return False
+        document = json.loads(response['Body'].read())
+        self.students = document.get("students", {})
+        self.leases = document.get("leases", {})
+        self.etag = response['ETag']
+        return True
+
+    def migrate(self):
+        # Deployments created before the state document existed only have the
+        # building/completed marker objects.
+        self.students = {}
+        s3_index = build_s3_index(self.s3_bucket)
+        for student_cluster_name, keys in s3_index.items():
+            if "building" in keys:
+                self.students[student_cluster_name] = {"status": "building"}
+            elif "completed" in keys:
+                self.students[student_cluster_name] = {"status": "complete"}
+        passwords = read_s3_objects(self.s3_bucket,
+                                    [os.path.join(name, KUBEADMIN_PASSWORD_FILE) for name in self.students
+                                     if KUBEADMIN_PASSWORD_FILE in s3_index[name]])
+        for key, password in passwords.items():
+            self.students[key.partition('/')[0]]["kubeadmin_password"] = password.decode()
+        if self.students:
+            log.info("Migrated {} students from marker files".format(len(self.students)))
+            try:
+                self.write()
+            except ClientError as e:
+                if not is_write_conflict(e):
+                    raise
+                # Another invocation created the document first
+                self.read()
+
+    @telemetry.timed('state.write')
+    def write(self):
+        body = json.dumps({"students": self.students, "leases": self.leases}, sort_keys=True)
+        write_conditions.headers = {'If-Match': self.etag} if self.etag else {'If-None-Match': '*'}
+        try:
+            response = get_client('s3').put_object(Body=body, Bucket=self.s3_bucket, Key=STATE_FILE,
+                                                   ContentType="text/json", ACL="private")
+        finally:
+            write_conditions.headers = {}
+        self.etag = response['ETag']
+
+    def update(self, student_cluster_name, attempt=False, **fields):
+        now = time.time()
+        with self.lock:
+            for retry in range(STATE_WRITE_ATTEMPTS):
+                if self.students is None:
+                    if not self.read():
+                        self.students = {}
+                student = self.students.setdefault(student_cluster_name, {"created": now})
+                if attempt:
+                    student["attempts"] = student.get("attempts", 0) + 1
+                student.update(fields)
+                student["updated"] = now
+                try:
+                    self.write()
+                    return student
+                except ClientError as e:
+                    if not is_write_conflict(e):
+                        raise
+                    log.debug("State document changed concurrently, reloading")
+                    self.students = None
+                    self.etag = None
+                    # Shard workers update the same document, spread their retries out
+                    time.sleep(random.uniform(0, min(1.0, 0.05 * 2 ** retry)))
+            raise Exception("Unable to update the state of {}".format(student_cluster_name))
+
+    def lease(self, name, owner, seconds):
+        """
+        Takes the lease ``name`` for ``seconds``, or releases it when ``seconds`` is 0.
+        Returns False when another owner holds a lease that has not expired yet.
+        """
+        with self.lock:
+            fresh = False
+            for retry in range(STATE_WRITE_ATTEMPTS):
+                if self.students is None:
+                    fresh = True
+                    if not self.read():
+                        self.students = {}
+                now = time.time()
+                current = self.leases.get(name)
+                if current and current["owner"] != owner and current["expires"] > now:
+                    if fresh:
+                        return False
+                    # The cached document may predate the release
+                    self.students = None
+                    continue
+                if seconds:
+                    self.leases[name] = {"owner": owner, "expires": now + seconds}
+                elif current:
+                    del self.leases[name]
+                else:
+                    return True
+                try:
+                    self.write()
+                    return True
+                except ClientError as e:
+                    if not is_write_conflict(e):
+                        raise
+                    self.students = None
+                    self.etag = None
+                    time.sleep(random.uniform(0, min(1.0, 0.05 * 2 ** retry)))
+            raise Exception("Unable to update the {} lease".format(name))
+
+def is_write_conflict(e):
+    return e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict')
+
+def get_state_store(s3_bucket):
+    global state_store
+    if state_store is None or state_store.s3_bucket != s3_bucket:
+        state_store = StateStore(s3_bucket)
+    return state_store
+
+def reset_state_store():
+    global state_store
+    state_store = None
+
+def log_stack_cache_stats():
+    if stack_cache is not None:
+        log.info("Stack status cache: {} hits, {} misses".format(stack_cache.hits, stack_cache.misses))
+
 def parse_properties(properties):
     cf_params = {'Capabilities': ['CAPABILITY_IAM',
                                   'CAPABILITY_AUTO_EXPAND',
@@ -74,14 +438,11 @@ def set_cloud9_password(cf_params, student_cluster_name, s3_bucket):
             param["ParameterValue"] = get_kubeadmin_pass(s3_bucket, student_cluster_name)
 
 def get_kubeadmin_pass(s3_bucket, student_cluster_name):
-    kubeadmin_file = os.path.join(student_cluster_name, "auth/kubeadmin-password")
-    local_kubeadmin_file = os.path.join("/tmp", student_cluster_name + "-admin")
-    get_from_s3(s3_bucket, source=kubeadmin_file, destination=local_kubeadmin_file)
+    kubeadmin_file = os.path.join(student_cluster_name, KUBEADMIN_PASSWORD_FILE)
     try:
-        cur_file = open(local_kubeadmin_file, "r")
-        return cur_file.read()
+        return read_s3_object(s3_bucket, kubeadmin_file).decode()
     except Exception as e:
-        log.info("Unable to open and read file")
+        log.info("Unable to read {}".format(kubeadmin_file))
         return "not found"
 
 def save_cfparams_json(cf_params, s3_bucket, student_cluster_name, create_cloud9_instance):
@@ -95,68 +456,188 @@ def save_cfparams_json(cf_params, s3_bucket, student_cluster_name, create_cloud9
                    content_type="text/json",
                    acl="private")
 
+@telemetry.timed('s3.list_objects')
+def build_s3_index(s3_bucket):
+    # A single paginated listing of the bucket replaces the per student head_object
+    # probes. The index maps each student to the keys stored under its prefix.
+    index = {}
+    pages = get_client('s3').get_paginator('list_objects_v2').paginate(Bucket=s3_bucket)
+    for page in pages:
+        for obj in page.get('Contents', []):
+            student_cluster_name, _, key = obj['Key'].partition('/')
+            if key:
+                index.setdefault(student_cluster_name, {})[key] = obj
+    return index
+
+def read_s3_objects(s3_bucket, keys, max_concurrency=4):
+    # Small objects are read straight into memory, concurrently
+    contents = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = {executor.submit(read_s3_object, s3_bucket, key): key for key in keys}
+        for future in as_completed(futures):
+            try:
+                contents[futures[future]] = future.result()
+            except Exception as e:
+                log.info("Unable to read {}: {}".format(futures[future], e))
+    return contents
+
 def build_stack_arr(cluster_name, number_of_students, hosted_zone_name, create_cloud9_instance, s3_bucket, openshift_version):
     stack_arr = []
+    students = get_state_store(s3_bucket).load()
     for i in range(number_of_students):
         student_cluster_name = cluster_name + '-' + 'student' + str(i)
-        building_key = os.path.join(student_cluster_name, "building")
-        complete_key = os.path.join(student_cluster_name, "completed")
+        student_state = students.get(student_cluster_name, {})
         fqdn_student_cluster_name = student_cluster_name + "." + hosted_zone_name
         stack_dict = {"name": student_cluster_name,
                     "number": i,
                     "ssh_url": "ssh.{}.{}".format(student_cluster_name, hosted_zone_name),
-                    "status": ""
+                    "status": student_state.get("status", ""),
+                    # Records written before the start time was kept only have the
+                    # time they were created, migrated ones not even that
+                    "started": student_state.get("started") or student_state.get("created")
         }
         if openshift_version != "3":
             stack_dict["console_url"] = "https://console-openshift-console.apps.{}.{}".format(student_cluster_name, hosted_zone_name)
             stack_dict["api_url"] = "https://api.{}:6443".format(fqdn_student_cluster_name)
         else:
             stack_dict["console_url"] = "https://{}.{}:8443/console".format(student_cluster_name, hosted_zone_name)
-        if check_file_s3(s3_bucket=s3_bucket, key=building_key):
-            stack_dict["status"] = "building"
-            stack_dict["kubeadmin_password"] = get_kubeadmin_pass(s3_bucket, student_cluster_name)
-        elif check_file_s3(s3_bucket=s3_bucket, key=complete_key):
-            stack_dict["status"] = "complete"
-            stack_dict["kubeadmin_password"] = get_kubeadmin_pass(s3_bucket, student_cluster_name)
+        if stack_dict["status"]:
+            stack_dict["kubeadmin_password"] = student_state.get("kubeadmin_password", "not found")
         if create_cloud9_instance:
             stack_dict["cloud_9_url"] = "https://console.aws.amazon.com/cloud9"
             # Get Account ID to print out on the workshop webpage
-            stack_dict["aws_account_id"] = boto3.client('sts').get_caller_identity().get('Account')
+            stack_dict["aws_account_id"] = get_account_id()
         stack_arr.append(stack_dict)
     log.debug("STACK DICTIONARY: {}".format(stack_arr))
     return stack_arr
 
-def install_dependencies(openshift_client_mirror_url, openshift_install_package, openshift_install_binary, download_path):
+@telemetry.timed('install_dependencies')
+def install_dependencies(openshift_client_mirror_url, openshift_install_package, openshift_install_binary, download_path, s3_bucket=None):
+    # Binaries are cached by the sha256 of the package they came from: first in /tmp for
+    # warm invocations, then in the AuthBucket for cold starts, and only downloaded from
+    # the mirror when neither has them.
+    start = time.time()
     sha256sum_file = 'sha256sum.txt'
     retries = 1
-    url = openshift_client_mirror_url + sha256sum_file
-    log.info("Downloading sha256sum file for OpenShift install client...")
-    url_retreive(url, download_path + sha256sum_file)
-    log.debug("Getting SHA256 hash for file {}".format(download_path + sha256sum_file))
-    sha256sum_dict = parse_sha256sum_file(download_path + sha256sum_file)
+    binary_path = download_path + openshift_install_binary
+    marker_file = binary_path + '.sha256'
+    sha256sum_dict = {}
+    if os.path.exists(download_path + sha256sum_file):
+        sha256sum_dict = parse_sha256sum_file(download_path + sha256sum_file)
+    if openshift_install_package not in sha256sum_dict:
+        url = openshift_client_mirror_url + sha256sum_file
+        log.info("Downloading sha256sum file for OpenShift install client...")
+        url_retreive(url, download_path + sha256sum_file)
+        log.debug("Getting SHA256 hash for file {}".format(download_path + sha256sum_file))
+        sha256sum_dict = parse_sha256sum_file(download_path + sha256sum_file)
     sha256sum = sha256sum_dict[openshift_install_package]
 
-    # Download the openshift install binary only if it doesn't exist and retry download if the sha256sum doesn't match
+    if os.path.exists(binary_path) and os.path.exists(marker_file) and open(marker_file).read() == sha256sum:
+        log.info("{} already installed from {} ({:.1f}s)".format(openshift_install_binary, openshift_install_package, time.time() - start))
+        return
+    cache_key = "/".join([ARTIFACT_CACHE_PREFIX, sha256sum, openshift_install_binary])
+    if s3_bucket and get_cached_binary(s3_bucket, cache_key, binary_path):
+        with open(marker_file, 'w') as file:
+            file.write(sha256sum)
+        log.info("{} installed from artifact cache ({:.1f}s)".format(openshift_install_binary, time.time() - start))
+        return
 
+    # Stream the openshift install package and retry download if the sha256sum doesn't match
     i = 0
     url = openshift_client_mirror_url + openshift_install_package
     while i <= retries:
         i += 1
-        if os.path.exists(download_path + openshift_install_package):
-            # Verify SHA256 hash
-            if verify_sha256sum(download_path + openshift_install_package, sha256sum):
-                log.info("OpenShift install client already exists in {}".format(download_path + openshift_install_package))
-                break
-        log.info("Downloading OpenShift install client...")
-        url_retreive(url, download_path + openshift_install_package)
-        if verify_sha256sum(download_path + openshift_install_package, sha256sum):
+        log.info("Downloading {} from the OpenShift install package...".format(openshift_install_binary))
+        if stream_install_binary(url, sha256sum, openshift_install_binary, binary_path):
             log.info("Successfuly downloaded OpenShift install client...")
             break
-    if not os.path.exists(download_path + openshift_install_binary):
-        log.info("Extracting the OpenShift install client...")
-        tar = tarfile.open(download_path + openshift_install_package)
-        tar.extractall(path=download_path)
-        tar.close()
+    else:
+        raise Exception("Unable to download {} with a matching SHA256 hash".format(url))
+    with open(marker_file, 'w') as file:
+        file.write(sha256sum)
+    if s3_bucket:
+        put_cached_binary(s3_bucket, cache_key, binary_path)
+    log.info("{} installed from mirror ({:.1f}s)".format(openshift_install_binary, time.time() - start))
+
+class HashingReader(object):
+    """
+    File-like wrapper that hashes everything read through it.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256_hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256_hash.update(data)
+        return data
+
+    def drain(self):
+        for chunk in iter(lambda: self.read(DOWNLOAD_CHUNK_SIZE), b""):
+            pass
+        return self.sha256_hash.hexdigest()
+
+@telemetry.timed('mirror.download', size=lambda result, url, sha256sum, binary, destination: os.path.getsize(destination) if result else 0)
+def stream_install_binary(url, sha256sum, binary, destination):
+    # Download, hash and extract in a single pass: the package never touches /tmp, only
+    # the requested member is written, and it only replaces the destination once the
+    # hash of the whole package has been verified.
+    log.debug("Streaming {} from URL: {} to {}".format(binary, url, destination))
+    import tarfile
+    partial_file = destination + '.part'
+    found = False
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+        package = HashingReader(response)
+        with tarfile.open(fileobj=package, mode='r|gz', bufsize=DOWNLOAD_CHUNK_SIZE) as tar:
+            for member in tar:
+                if member.isfile() and member.name == binary:
+                    with tar.extractfile(member) as source, open(partial_file, 'wb') as file:
+                        for chunk in iter(lambda: source.read(DOWNLOAD_CHUNK_SIZE), b""):
+                            file.write(chunk)
+                    found = True
+                    break
+        package_sha256sum = package.drain()
+    if package_sha256sum != sha256sum or not found:
+        log.info("File {} SHA256 hash is {}".format(url, package_sha256sum))
+        log.info("Expecting {}, {} found: {}".format(sha256sum, binary, found))
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        return False
+    os.chmod(partial_file, 0o755)
+    os.rename(partial_file, destination)
+    return True
+
+@telemetry.timed('s3.get_cached_binary')
+def get_cached_binary(s3_bucket, cache_key, destination):
+    client = get_client('s3')
+    try:
+        response = client.get_object(Bucket=s3_bucket, Key=cache_key)
+    except ClientError:
+        log.debug("{} not in artifact cache".format(cache_key))
+        return False
+    sha256_hash = hashlib.sha256()
+    with open(destination, 'wb') as file:
+        for chunk in response['Body'].iter_chunks(DOWNLOAD_CHUNK_SIZE):
+            sha256_hash.update(chunk)
+            file.write(chunk)
+    if sha256_hash.hexdigest() != response['Metadata'].get('sha256'):
+        log.info("Cached {} is corrupt, ignoring it".format(cache_key))
+        os.remove(destination)
+        return False
+    os.chmod(destination, 0o755)
+    return True
+
+@telemetry.timed('s3.put_cached_binary')
+def put_cached_binary(s3_bucket, cache_key, binary_path):
+    sha256_hash = hashlib.sha256()
+    with open(binary_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256_hash.update(chunk)
+    try:
+        get_client('s3').upload_file(binary_path, s3_bucket, cache_key,
+                                     ExtraArgs={'Metadata': {'sha256': sha256_hash.hexdigest()}})
+    except Exception as e:
+        log.error("Unable to cache {} in {}: {}".format(binary_path, s3_bucket, e))
 
 def url_retreive(url, download_path):
     log.debug("Downloading from URL: {} to {}".format(url, download_path))
@@ -180,380 +661,1275 @@ def parse_sha256sum_file(filename):
     sha256sums = dict((v,k) for k,v in tmp_dict.items())
     return sha256sums
 
-def verify_sha256sum(filename, sha256sum):
-    sha256_hash = hashlib.sha256()
-    with open(filename,"rb") as file:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: file.read(4096),b""):
-            sha256_hash.update(byte_block)
-    if sha256_hash.hexdigest() == sha256sum:
-        return True
-    else:
-        log.info("File {} SHA256 hash is {}".format(filename, sha256_hash.hexdigest()))
-        log.info("Expecting {}".format(sha256sum))
+class AddressSpace(object):
+    """
+    Non-overlapping networks kept sorted by address, so a candidate is checked
+    against its two neighbours only.
+    """
+    def __init__(self):
+        self.starts = []
+        self.networks = []
+
+    def overlaps(self, network):
+        i = bisect.bisect_right(self.starts, int(network.network_address))
+        return (i > 0 and self.networks[i - 1].broadcast_address >= network.network_address) \
+            or (i < len(self.networks) and self.networks[i].network_address <= network.broadcast_address)
+
+    def add(self, network):
+        i = bisect.bisect_right(self.starts, int(network.network_address))
+        self.starts.insert(i, int(network.network_address))
+        self.networks.insert(i, network)
+
+def candidate_networks(base):
+    # Blocks the size of base: from base to the end of its private range, then from the
+    # start of that range, then the other private ranges
+    pools = [pool for pool in PRIVATE_NETWORKS if base.subnet_of(pool)]
+    if not pools:
+        raise Exception("Network {} in install-config.yaml is not a private network".format(base))
+    pools += [pool for pool in PRIVATE_NETWORKS if pool != pools[0] and pool.prefixlen <= base.prefixlen]
+    size = base.num_addresses
+    for n, pool in enumerate(pools):
+        first = int(pool.network_address)
+        count = pool.num_addresses // size
+        offset = (int(base.network_address) - first) // size if n == 0 else 0
+        for i in itertools.chain(range(offset, count), range(0, offset)):
+            yield ipaddress.ip_network((first + i * size, base.prefixlen))
+
+def allocate_networks(base, names, taken):
+    allocated = {}
+    candidates = candidate_networks(base)
+    for name in names:
+        for network in candidates:
+            if not taken.overlaps(network):
+                taken.add(network)
+                allocated[name] = str(network)
+                break
+        else:
+            raise Exception("Private address space exhausted after {} networks of {}, use smaller networks "
+                            "in install-config.yaml".format(len(allocated), base))
+    return allocated
+
+def validate_network_plan(plan, reserved):
+    # Sort and sweep every network of the plan, each one has to start after the
+    # furthest end seen so far
+    # The VPC usually is the machine network, reserved networks may overlap each other
+    networks = [(network, "reserved") for network in
+                ipaddress.collapse_addresses(ipaddress.ip_network(cidr) for cidr in reserved)]
+    for student, student_networks in plan.items():
+        networks.extend((ipaddress.ip_network(cidr), "student{} {}".format(student, kind))
+                        for kind, cidr in student_networks.items())
+    networks.sort(key=lambda item: (item[0].network_address, item[0].broadcast_address))
+    furthest = None
+    for network, owner in networks:
+        if not any(network.subnet_of(pool) for pool in PRIVATE_NETWORKS):
+            raise Exception("{} network {} is not a private network".format(owner, network))
+        if furthest and network.network_address <= furthest[0].broadcast_address:
+            raise Exception("{} network {} overlaps {} network {}".format(owner, network, furthest[1], furthest[0]))
+        if furthest is None or network.broadcast_address > furthest[0].broadcast_address:
+            furthest = (network, owner)
+
+def plan_networks(install_config, number_of_students, vpc_cidr=None, plan=None):
+    """
+    Returns the clusterNetwork and serviceNetwork of every student keyed by student
+    number. Students already in ``plan`` keep their networks, reserved networks (the
+    machine network and the VPC) are never handed out.
+    """
+    networking = install_config['networking']
+    machine_networks = [entry['cidr'] for entry in networking.get('machineNetwork', [])] or [DEFAULT_MACHINE_NETWORK]
+    reserved = machine_networks + ([vpc_cidr] if vpc_cidr else [])
+    plan = dict(plan or {})
+    taken = AddressSpace()
+    for network in ipaddress.collapse_addresses(ipaddress.ip_network(cidr) for cidr in reserved):
+        taken.add(network)
+    for student_networks in plan.values():
+        for cidr in student_networks.values():
+            taken.add(ipaddress.ip_network(cidr))
+    missing = [str(i) for i in range(number_of_students) if str(i) not in plan]
+    if missing:
+        cluster_networks = allocate_networks(ipaddress.ip_network(networking['clusterNetwork'][0]['cidr']),
+                                             missing, taken)
+        service_networks = allocate_networks(ipaddress.ip_network(networking['serviceNetwork'][0]),
+                                             missing, taken)
+        for student in missing:
+            plan[student] = {"clusterNetwork": cluster_networks[student],
+                             "serviceNetwork": service_networks[student]}
+    validate_network_plan(plan, reserved)
+    return plan
+
+def load_install_config():
+    # Parsed once per container, every caller gets its own copy to modify
+    global base_install_config
+    if base_install_config is None:
+        from ruamel import yaml
+        base_install_config = yaml.safe_load(open('install-config.yaml', 'r'))
+    return copy.deepcopy(base_install_config)
+
+@telemetry.timed('network_plan')
+def load_network_plan(s3_bucket, number_of_students, vpc_cidr=None):
+    # Reads the persisted plan, extends it to the class size and validates it. Raises
+    # before any installer or CloudFormation work when the class does not fit.
+    install_config = load_install_config()
+    base = {"networking": install_config['networking'], "vpc_cidr": vpc_cidr}
+    try:
+        saved = json.loads(read_s3_object(s3_bucket, NETWORK_PLAN_FILE))
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        saved = {}
+    if saved.get("base") != base:
+        if saved:
+            log.warning("install-config.yaml networks or the VPC changed, planning networks again")
+        saved = {"base": base, "students": {}}
+    plan = plan_networks(install_config, number_of_students, vpc_cidr, saved["students"])
+    if plan != saved["students"]:
+        add_file_to_s3(s3_bucket, json.dumps({"base": base, "students": plan}, sort_keys=True),
+                       NETWORK_PLAN_FILE, "text/json", "private")
+        log.info("Planned networks for {} students".format(len(plan)))
+    return plan
+
+def render_install_config(student_cluster_name, ssh_key, pull_secret, hosted_zone_name, networks):
+    openshift_install_config = load_install_config()
+    openshift_install_config['metadata']['name'] = student_cluster_name
+    openshift_install_config['sshKey'] = ssh_key
+    openshift_install_config['pullSecret'] = pull_secret
+    openshift_install_config['baseDomain'] = hosted_zone_name
+
+    # Network updates, every student gets its own networks from the network plan
+    openshift_install_config['networking']['clusterNetwork'][0]['cidr'] = networks['clusterNetwork']
+    openshift_install_config['networking']['serviceNetwork'][0] = networks['serviceNetwork']
+    return openshift_install_config
+
+def install_config_digest(openshift_install_config):
+    return hashlib.sha256(json.dumps(openshift_install_config, sort_keys=True).encode()).hexdigest()
+
+def verify_ignition_bundle(assets_directory, student_cluster_name, hosted_zone_name):
+    # Make sure a bundle belongs to this student before it is reused or uploaded: every
+    # file must exist, the ignition configs must parse and the kubeconfig must point at
+    # this student's API endpoint.
+    for file in IGNITION_FILES:
+        if not os.path.exists(os.path.join(assets_directory, file)):
+            log.info("Ignition bundle for {} is missing {}".format(student_cluster_name, file))
+            return False
+    from ruamel import yaml
+    try:
+        for file in ['master.ign', 'bootstrap.ign']:
+            json.load(open(os.path.join(assets_directory, file)))
+        kubeconfig = yaml.safe_load(open(os.path.join(assets_directory, 'auth/kubeconfig')))
+        server = kubeconfig['clusters'][0]['cluster']['server']
+    except Exception as e:
+        log.info("Ignition bundle for {} is unreadable: {}".format(student_cluster_name, e))
+        return False
+    expected_server = "https://api.{}.{}:6443".format(student_cluster_name, hosted_zone_name)
+    if server != expected_server:
+        log.info("Ignition bundle for {} points at {}, expecting {}".format(student_cluster_name, server, expected_server))
+        return False
+    return True
+
+def ignition_bundle_cached(s3_bucket, student_cluster_name, config_digest, stored):
+    # The bundle in S3 can be reused when it was generated from the same install-config
+    # recently enough for the bootstrap certificates to still be valid. ``stored`` is
+    # the listing of the student prefix.
+    cache_key = os.path.join(student_cluster_name, IGNITION_CACHE_FILE)
+    if cache_key not in stored:
+        return False
+    try:
+        cache = json.loads(read_s3_object(s3_bucket, cache_key))
+    except Exception:
+        return False
+    if cache.get("digest") != config_digest:
         return False
+    if time.time() - cache.get("created", 0) > IGNITION_CACHE_MAX_AGE:
+        log.info("Cached ignition files for {} are too old, regenerating".format(student_cluster_name))
+        return False
+    return all(os.path.join(student_cluster_name, file) in stored for file in IGNITION_FILES)
 
-def update_cidr(student_num, multiplicitive, cidr, octect):
-    # If we have 10.30.0.0/16 and we need to update .30 we need to split and grab the second octect
-    # But computers start at 0 so it would be '1'
-    ip = cidr.split('.')
-    ip[octect] = int(ip[octect]) + (student_num * multiplicitive)
-    return '.'.join(map(str, ip))
+def save_ignition_cache(s3_bucket, student_cluster_name, config_digest):
+    add_file_to_s3(s3_bucket=s3_bucket,
+                   body=json.dumps({"digest": config_digest, "created": time.time()}),
+                   key=os.path.join(student_cluster_name, IGNITION_CACHE_FILE),
+                   content_type="text/json",
+                   acl="private")
 
-def generate_ignition_files(openshift_install_binary, download_path, student_cluster_name, ssh_key, pull_secret, hosted_zone_name, student_num):
+@telemetry.timed('generate_ignition_files')
+def generate_ignition_files(openshift_install_binary, download_path, student_cluster_name, ssh_key, pull_secret, hosted_zone_name, networks):
     assets_directory = download_path + student_cluster_name
     install_config_file = 'install-config.yaml'
+    digest_file = os.path.join(assets_directory, IGNITION_CACHE_FILE)
     log.debug("Creating OpenShift assets directory for {}...".format(student_cluster_name))
     if not os.path.exists(assets_directory):
         os.mkdir(assets_directory)
     log.info("Generating install-config file for {}...".format(student_cluster_name))
-    openshift_install_config = yaml.safe_load(open(install_config_file, 'r'))
-    openshift_install_config['metadata']['name'] = student_cluster_name
-    openshift_install_config['sshKey'] = ssh_key
-    openshift_install_config['pullSecret'] = pull_secret
-    openshift_install_config['baseDomain'] = hosted_zone_name
+    openshift_install_config = render_install_config(student_cluster_name, ssh_key, pull_secret,
+                                                     hosted_zone_name, networks)
+    config_digest = install_config_digest(openshift_install_config)
 
-    # Network updates
-    orig_cluster_network = openshift_install_config['networking']['clusterNetwork'][0]['cidr']
-    # We need to update the cluster networks 10.30.0.0/16 to 10.31.0.0/16 or +1 in second octect for each student
-    openshift_install_config['networking']['clusterNetwork'][0]['cidr'] = update_cidr(student_num, 1, orig_cluster_network, 1)
-    orig_service_network = openshift_install_config['networking']['serviceNetwork'][0]
-    openshift_install_config['networking']['serviceNetwork'][0] = update_cidr(student_num, 1, orig_service_network, 1)
+    # A warm Lambda may still hold the assets generated from the same install-config
+    if os.path.exists(digest_file) and open(digest_file).read() == config_digest \
+            and verify_ignition_bundle(assets_directory, student_cluster_name, hosted_zone_name):
+        log.info("Reusing ignition files for {}...".format(student_cluster_name))
+        return config_digest
 
+    from ruamel import yaml
     cluster_install_config_file = os.path.join(assets_directory, install_config_file)
     # Using this to get around the ssh-key multiline issue in yaml
     yaml.dump(openshift_install_config,
               open(cluster_install_config_file, 'w'),
               explicit_start=True, default_style='\"',
               width=4096)
-    log.info("Generating manifests for {}...".format(student_cluster_name))
-    cmd = download_path + openshift_install_binary + " create manifests --dir {}".format(assets_directory)
-    run_process(cmd)
+    # create ignition-configs generates the manifests itself, a separate
+    # "create manifests" run is only needed when the manifests get customized.
     log.info("Generating ignition files for {}...".format(student_cluster_name))
-    cmd = download_path + openshift_install_binary + " create ignition-configs --dir {}".format(assets_directory)
-    run_process(cmd)
+    run_process([download_path + openshift_install_binary, "create", "ignition-configs",
+                 "--dir", assets_directory])
+    if not verify_ignition_bundle(assets_directory, student_cluster_name, hosted_zone_name):
+        raise Exception("Generated ignition files for {} failed verification".format(student_cluster_name))
+    with open(digest_file, 'w') as file:
+        file.write(config_digest)
+    return config_digest
 
-def run_process(cmd):
-    try:
-        proc = subprocess.run([cmd], capture_output=True, shell=True)
-        proc.check_returncode()
-        log.debug(proc.returncode)
-        log.debug(proc.stdout)
-        log.debug(proc.stderr)
-    except subprocess.CalledProcessError as e:
-        log.error("Error Detected on cmd {} with error {}".format(e.cmd, e.stderr))
-        log.error(e.cmd)
-        log.error(e.stderr)
-        log.error(e.stdout)
-        raise
-    except OSError as e:
-        log.error("Error Detected on cmd {} with error {}".format(e.cmd, e.stderr))
-        log.error("OSError: {}".format(e.errno))
-        log.error(e.strerror)
-        log.error(e.filename)
-        raise
+def set_process_deadline(context):
+    # Commands are killed WAITER_DEADLINE_MARGIN seconds before the Lambda times out
+    global process_deadline
+    process_deadline = time.time() + remaining_seconds(context) - WAITER_DEADLINE_MARGIN
 
-def upload_file_to_s3(s3_path, local_path, s3_bucket):
-    client = boto3.client('s3')
-    log.info("Uploading {} to s3 bucket {}...".format(local_path, os.path.join(s3_bucket, s3_path)))
-    try:
-        client.head_object(Bucket=s3_bucket, Key=s3_path)
-        log.debug("File found on S3! Skipping {}...".format(s3_path))
-    except:
-        client.upload_file(local_path, s3_bucket, s3_path)
-
-def upload_ignition_files_to_s3(local_student_folder, s3_bucket):
-    files_to_upload = ['auth/kubeconfig', 'auth/kubeadmin-password', 'master.ign', 'bootstrap.ign']
-    for file in files_to_upload:
-        s3_path = os.path.join(os.path.basename(local_student_folder), file)
-        local_path = os.path.join(local_student_folder, file)
-        upload_file_to_s3(s3_path, local_path, s3_bucket)
-
-def delete_contents_s3(s3_bucket):
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(s3_bucket)
+def process_timeout(timeout=PROCESS_TIMEOUT):
+    if process_deadline is None:
+        return timeout
+    return min(timeout, process_deadline - time.time())
+
+@telemetry.timed('run_process')
+def run_process(argv, timeout=PROCESS_TIMEOUT, cwd=None):
+    """
+    Runs ``argv`` without a shell and streams its output to the debug log.
+    Raises CalledProcessError on a non zero exit and TimeoutExpired when the command
+    outlives its timeout or the invocation deadline, both carry the output tail.
+    """
+    import subprocess
+    name = os.path.basename(argv[0])
+    with process_slots:
+        timeout = process_timeout(timeout)
+        if timeout <= 0:
+            raise subprocess.TimeoutExpired(argv, 0)
+        log.debug("Running {} with a {:.0f}s timeout".format(" ".join(argv), timeout))
+        # A new session lets the whole process group be killed, the scale script
+        # would otherwise leave its oc children holding the output pipe open.
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                cwd=cwd, start_new_session=True)
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        tail = deque(maxlen=PROCESS_OUTPUT_LINES)
+        try:
+            for line in iter(lambda: proc.stdout.readline(PROCESS_LINE_LIMIT), b''):
+                line = line.decode('utf-8', 'replace').rstrip()
+                tail.append(line)
+                log.debug("{}: {}".format(name, line))
+            returncode = proc.wait()
+        finally:
+            timer.cancel()
+            proc.stdout.close()
+    output = "\n".join(tail)
+    if timed_out.is_set():
+        log.error("{} killed after {:.0f}s:\n{}".format(" ".join(argv), timeout, output))
+        raise subprocess.TimeoutExpired(argv, timeout, output=output)
+    if returncode != 0:
+        log.error("{} exited with {}:\n{}".format(" ".join(argv), returncode, output))
+        raise subprocess.CalledProcessError(returncode, argv, output=output)
+    return output
+
+@telemetry.timed('s3.list_etags')
+def list_s3_etags(s3_bucket, prefix):
+    # Key to ETag of every object under the prefix
+    etags = {}
+    for page in get_client('s3').get_paginator('list_objects_v2').paginate(Bucket=s3_bucket, Prefix=prefix):
+        etags.update((item['Key'], item['ETag']) for item in page.get('Contents', []))
+    return etags
+
+def sync_ignition_files(local_student_folder, s3_bucket, stored=None,
+                        max_concurrency=IGNITION_SYNC_CONCURRENCY):
+    """
+    Uploads the ignition assets of a student whose stored copy differs, concurrently.
+    Single part uploads have the MD5 of their body as ETag, anything else (a different
+    body or an SSE-KMS bucket) is uploaded again.
+    ``stored`` is the listing of the student prefix, listed here when not given.
+    Returns the number of files and bytes uploaded and skipped.
+    """
+    student_cluster_name = os.path.basename(local_student_folder)
+    if stored is None:
+        stored = list_s3_etags(s3_bucket, student_cluster_name + '/')
+    result = {"uploaded": 0, "uploaded_bytes": 0, "skipped": 0, "skipped_bytes": 0}
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = []
+        for file in IGNITION_FILES:
+            key = os.path.join(student_cluster_name, file)
+            with open(os.path.join(local_student_folder, file), 'rb') as local_file:
+                body = local_file.read()
+            if stored.get(key) == '"{}"'.format(hashlib.md5(body).hexdigest()):
+                result["skipped"] += 1
+                result["skipped_bytes"] += len(body)
+                continue
+            log.debug("Uploading {} to s3 bucket {}...".format(key, s3_bucket))
+            futures.append(executor.submit(run_for_student, student_cluster_name, add_file_to_s3,
+                                           s3_bucket, body, key, "application/octet-stream", "private"))
+            result["uploaded"] += 1
+            result["uploaded_bytes"] += len(body)
+        for future in futures:
+            future.result()
+    telemetry.record('ignition.skipped', 0, result["skipped_bytes"])
+    log.info("Synced ignition files for {}: uploaded {} ({} bytes), skipped {} ({} bytes)".format(
+        student_cluster_name, result["uploaded"], result["uploaded_bytes"], result["skipped"], result["skipped_bytes"]))
+    return result
+
+@telemetry.timed('s3.delete_contents')
+def delete_contents_s3(s3_bucket, context=None, max_concurrency=S3_DELETE_CONCURRENCY):
+    # Every listing page is removed with a single delete_objects request, several pages
+    # at a time, and a fresh listing has to come back empty before the bucket counts
+    # as clean. Returns "complete", or "pending" when the deadline hit first.
+    client = get_client('s3')
     try:
-        log.debug("Deleting bucket {}...".format(s3_bucket))
-        bucket.objects.all().delete()
+        for cleanup_pass in range(S3_DELETE_PASSES):
+            log.debug("Deleting contents of bucket {}, pass {}...".format(s3_bucket, cleanup_pass + 1))
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                futures = []
+                for page in client.get_paginator('list_objects_v2').paginate(
+                        Bucket=s3_bucket, PaginationConfig={'PageSize': S3_DELETE_BATCH}):
+                    keys = [{'Key': item['Key']} for item in page.get('Contents', [])]
+                    if keys:
+                        futures.append(executor.submit(delete_objects_s3, s3_bucket, keys))
+                    if remaining_seconds(context) < WAITER_DEADLINE_MARGIN:
+                        break
+                deleted = sum(future.result() for future in futures)
+            if client.list_objects_v2(Bucket=s3_bucket, MaxKeys=1)['KeyCount'] == 0:
+                log.info("Deleted {} objects from bucket {}".format(deleted, s3_bucket))
+                return "complete"
+            if remaining_seconds(context) < WAITER_DEADLINE_MARGIN:
+                return "pending"
     except ClientError as e:
-        # If a client error is thrown, then check that it was a 404 error.
         # If it was a 404 error, then the bucket does not exist.
-        error_code = e.response['Error']['Code']
-        if error_code == "NoSuchBucket":
+        if e.response['Error']['Code'] == "NoSuchBucket":
             log.debug("{} does not exist, skipping...".format(s3_bucket))
-            return
-        else:
-            log.error("Failed to delete bucket, unhandled exception {}".format(e))
-    except Exception as e:
-        log.error("Failed to delete bucket, unhandled exception {}".format(e))
+            return "complete"
+        raise
+    raise Exception("Bucket {} still not empty after {} passes".format(s3_bucket, S3_DELETE_PASSES))
+
+def delete_objects_s3(s3_bucket, keys):
+    response = get_client('s3').delete_objects(Bucket=s3_bucket, Delete={'Objects': keys, 'Quiet': True})
+    errors = response.get('Errors', [])
+    if errors:
+        raise Exception("Failed to delete {} objects from {}, first error {}: {}".format(
+            len(errors), s3_bucket, errors[0]['Key'], errors[0].get('Message')))
+    return len(keys)
 
-def get_from_s3(s3_bucket, source, destination):
-    client = boto3.client('s3')
-    if check_file_s3(s3_bucket,key=source):
-        client.download_file(s3_bucket, source, destination)
+@telemetry.timed('s3.get_object', size=lambda result, *args: len(result))
+def read_s3_object(s3_bucket, key):
+    client = get_client('s3')
+    return client.get_object(Bucket=s3_bucket, Key=key)['Body'].read()
 
+@telemetry.timed('s3.put_object', size=lambda result, s3_bucket, body, *args, **kwargs: len(body))
 def add_file_to_s3(s3_bucket, body, key, content_type, acl):
-    client = boto3.client('s3')
+    client = get_client('s3')
     client.put_object(Body=body, Bucket=s3_bucket, Key=key,
                     ContentType=content_type, ACL=acl)
 
-def delete_s3_file(s3_bucket, file_name):
-    client = boto3.client('s3')
-    client.delete_object(Bucket=s3_bucket, Key=file_name)
+def count_s3_request(**kwargs):
+    global s3_request_count
+    with s3_request_lock:
+        s3_request_count += 1
 
-def check_file_s3(s3_bucket,key):
-    client = boto3.client('s3')
-    try:
-        client.head_object(Bucket=s3_bucket, Key=key)
-        log.debug("File at location {} found".format(key))
-        return True
-    except Exception as e:
-        log.debug("File not found at {} and key {}".format(s3_bucket,key))
-        return False
+def reset_s3_request_count():
+    global s3_request_count
+    with s3_request_lock:
+        s3_request_count = 0
 
-def cluster_availabe(url):
-    response = False
+@telemetry.timed('probe_cluster')
+def probe_cluster(url, timeout=PROBE_TIMEOUT):
+    # The cluster API serves a certificate signed by the cluster's own CA, so a failed
+    # certificate verification means the API answered the TLS handshake.
     try:
         log.debug("Checking cluster API at {}".format(url))
-        urllib.request.urlopen(url)
+        urllib.request.urlopen(url, timeout=timeout)
+        return "reachable"
+    except urllib.error.HTTPError:
+        return "reachable"
     except urllib.error.URLError as e:
-        if "CERTIFICATE_VERIFY_FAILED" in e.reason.strerror:
-            response = True
-            log.debug("Cluster is reachable at {}".format(url))
-    except:
-        log.error("Unhandled exception, cluster must not be ready")
-    return response
+        reason = e.reason
+    except Exception as e:
+        reason = e
+    if isinstance(reason, ssl.SSLCertVerificationError):
+        return "reachable"
+    if isinstance(reason, ssl.SSLError):
+        return "cert-pending"
+    if isinstance(reason, socket.gaierror):
+        return "dns-missing"
+    if isinstance(reason, socket.timeout):
+        return "timeout"
+    log.debug("Cluster API at {} not ready: {}".format(url, reason))
+    return "unreachable"
+
+def probe_clusters(stacks, max_concurrency=PROBE_CONCURRENCY):
+    results = {}
+    if not stacks:
+        return results
+    with ThreadPoolExecutor(max_workers=min(len(stacks), max_concurrency)) as executor:
+        futures = {executor.submit(run_for_student, stack["name"], probe_cluster, stack["api_url"]): stack["name"]
+                   for stack in stacks}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
 
+@telemetry.timed('scale_ocp_replicas')
 def scale_ocp_replicas(s3_bucket, student_cluster_name, status):
-    complete_key = os.path.join(student_cluster_name, "completed")
-    building_key = os.path.join(student_cluster_name, "building")
-    kubeconfig_file = os.path.join(student_cluster_name, "auth/kubeconfig")
-    local_kubeconfig_file = os.path.join("/tmp", student_cluster_name + "kubeconfig")
-    get_from_s3(s3_bucket, kubeconfig_file, local_kubeconfig_file)
-    cmd = "./bin/openshift-4-scale-replicas {}".format(local_kubeconfig_file)
+    # Returns "complete", "retry" when scaling should be tried again on the next
+    # Validate run, or "failed" when the cluster has no console and must be rebuilt.
+    import kube_scaler
+    state_store = get_state_store(s3_bucket)
     try:
-        run_process(cmd)
-        # If the scale replicas script ran correctly, the status is now complete
-        if status == "building":
-            delete_s3_file(s3_bucket, building_key)
-        add_file_to_s3(s3_bucket=s3_bucket,body="completed",key=complete_key,
-                        content_type="text/plain", acl="private")
-        return True
+        kubeconfig = read_s3_object(s3_bucket, os.path.join(student_cluster_name, "auth/kubeconfig"))
+        failed = kube_scaler.scale_down(kubeconfig, wait_timeout=process_timeout(kube_scaler.WAIT_TIMEOUT))
     except Exception as e:
-        log.error(e)
-        log.error("Unhandled Exception")
-        return False
+        failed = {"kubeconfig": e}
+    for step, error in failed.items():
+        log.error("Scaling {} failed at {}: {}".format(student_cluster_name, step, error))
+    if isinstance(failed.get("console"), kube_scaler.ConsoleMissing):
+        return "failed"
+    if failed:
+        scale_attempts = state_store.load().get(student_cluster_name, {}).get("scale_attempts", 0) + 1
+        if scale_attempts < SCALE_MAX_ATTEMPTS:
+            state_store.update(student_cluster_name, scale_attempts=scale_attempts)
+            return "retry"
+        log.warning("Accepting {} after {} scaling attempts".format(student_cluster_name, scale_attempts))
+    # The status is now complete
+    state_store.update(student_cluster_name, status="complete", completed=time.time())
+    return "complete"
+
+@telemetry.timed('events.put_rule')
+def schedule_validate_event(cluster_name, stack_arr):
+    # Fire the ValidateEvent again when the first unfinished cluster is due, the rule
+    # is only rewritten when the interval changes.
+    next_checks = [stack["next_check"] for stack in stack_arr
+                   if stack["status"] not in ("complete", "failed") and "next_check" in stack]
+    if not next_checks:
+        deactivate_event(cluster_name)
+        return
+    delay = min(VALIDATE_MAX_INTERVAL, max(VALIDATE_MIN_INTERVAL, min(next_checks) - time.time()))
+    schedule = "rate({} minutes)".format(int(math.ceil(delay / 60.0)))
+    client = get_client('events')
+    event_name = cluster_name + "-ValidateEvent"
+    rule = client.describe_rule(Name=event_name)
+    if rule.get('ScheduleExpression') == schedule and rule.get('State') == 'ENABLED':
+        log.debug("Validate event already scheduled at {}".format(schedule))
+        return
+    log.info("Scheduling validate event at {}".format(schedule))
+    client.put_rule(Name=event_name, ScheduleExpression=schedule, State='ENABLED',
+                    Description=rule.get('Description', ''))
 
+@telemetry.timed('events.disable_rule')
 def deactivate_event(cluster_name):
     log.info("Deactivating event")
-    client = boto3.client('events')
+    client = get_client('events')
     event_name = cluster_name + "-ValidateEvent"
     response = client.disable_rule(Name=event_name)
     log.debug(response)
 
-def wait_for_stack_state(waiter_array):
-    cf_client = boto3.client("cloudformation")
-    while( len(waiter_array) > 0 ):
-        cur_waiter = waiter_array.pop()
-        waiter = cf_client.get_waiter(cur_waiter["stack_state"])
-        log.debug('Waiting for stack {} state {}...'.format(cur_waiter["stack_name"], cur_waiter["stack_state"]))
-        try:
-            waiter.wait(StackName=cur_waiter["stack_name"])
-        except Exception as e:
-            log.error("Caught exception in Waiter..{}, adding it back to the array".format(e))
-            waiter_array.append(cur_waiter)
+def run_for_student(student_cluster_name, func, *args):
+    # Runs func in a worker thread with its calls attributed to the student
+    with telemetry.student(student_cluster_name):
+        return func(*args)
+
+def set_request_deadline(event):
+    # The first invocation of a CloudFormation request records when it started, the
+    # continuations and shard workers get it with their event
+    global request_deadline
+    if 'RequestType' not in event:
+        request_deadline = None
+        return event
+    event = dict(event, Started=event.get("Started", time.time()))
+    request_deadline = event["Started"] + REQUEST_DEADLINE
+    return event
 
-def build_stacks(params_array):
+def remaining_seconds(context):
+    remaining = float('inf')
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        remaining = context.get_remaining_time_in_millis() / 1000.0
+    if request_deadline is not None:
+        remaining = min(remaining, request_deadline - time.time())
+    return remaining
+
+@telemetry.timed('cloudformation.wait')
+def wait_for_stack_state(waiter_array, context=None):
+    # Poll every pending stack together: one paginated describe_stacks per round
+    # instead of one blocking boto3 waiter per stack. Returns a map of stack name to
+    # "complete", "failed" or "pending" when the deadline hit first.
+    cf_client = get_client('cloudformation')
+    pending = {w["stack_name"]: w["stack_state"] for w in waiter_array}
+    outcome = {}
+    delay = WAITER_MIN_DELAY
+    while pending:
+        stacks = {}
+        for page in cf_client.get_paginator('describe_stacks').paginate():
+            for stack in page.get('Stacks', []):
+                stacks[stack['StackName']] = stack
+        changed = False
+        for stack_name, stack_state in list(pending.items()):
+            stack = stacks.get(stack_name)
+            status = stack['StackStatus'] if stack else 'DELETE_COMPLETE'
+            get_stack_cache().update(stack_name, stack)
+            success, failure = WAITER_STATES[stack_state]
+            if status in success:
+                outcome[stack_name] = "complete"
+            elif status in failure:
+                log.error("Stack {} ended in {}".format(stack_name, status))
+                outcome[stack_name] = "failed"
+            else:
+                continue
+            log.debug("Stack {} reached {}".format(stack_name, status))
+            del pending[stack_name]
+            changed = True
+        if not pending:
+            break
+        # Back off while nothing moves, poll quickly again once stacks start finishing
+        delay = WAITER_MIN_DELAY if changed else min(delay * 2, WAITER_MAX_DELAY)
+        if remaining_seconds(context) - delay < WAITER_DEADLINE_MARGIN:
+            log.info("Deadline reached with {} stacks pending".format(len(pending)))
+            break
+        log.debug("Waiting {}s on {} stacks...".format(delay, len(pending)))
+        time.sleep(delay)
+    for stack_name in pending:
+        outcome[stack_name] = "pending"
+    return outcome
+
+def hand_off(event, context):
+    # Continue the work in a fresh invocation of this function instead of timing out.
+    # The follow-up invocation is the one that answers CloudFormation.
+    continuation = event.get("Continuation", 0) + 1
+    if remaining_seconds(None) < 2 * WAITER_DEADLINE_MARGIN:
+        log.error("Giving up after {} continuations, CloudFormation stops waiting soon".format(continuation - 1))
+        return False
+    log.info("Handing off to continuation {}".format(continuation))
+    get_client('lambda').invoke(FunctionName=context.invoked_function_arn,
+                                InvocationType='Event',
+                                Payload=json.dumps(dict(event, Continuation=continuation)))
+    return True
+
+def plan_shards(number_of_students, students_per_worker):
+    # Consecutive student numbers, students_per_worker of them per shard
+    return [list(range(first, min(first + students_per_worker, number_of_students)))
+            for first in range(0, number_of_students, students_per_worker)]
+
+def dispatch_shards(event, shards, context):
+    # Every shard runs in its own invocation of this function: an asynchronous Lambda
+    # invoke, or a local worker process when ShardDispatch is "local". Workers report
+    # through save_shard_result and never answer CloudFormation themselves.
+    # Returns the local process pool, if any.
+    workers = None
+    if os.getenv('ShardDispatch', 'lambda') == 'local':
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Spawned rather than forked, a child must not inherit the pooled connections
+        workers = ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context('spawn'))
+    for shard_id, students in enumerate(shards):
+        worker_event = dict(event, Shard={"Id": shard_id, "Students": students})
+        worker_event.pop("Continuation", None)
+        if workers:
+            workers.submit(handler, worker_event, None)
+        else:
+            get_client('lambda').invoke(FunctionName=context.invoked_function_arn,
+                                        InvocationType='Event',
+                                        Payload=json.dumps(worker_event))
+    log.info("Dispatched {} shards of up to {} students".format(len(shards), max(len(s) for s in shards)))
+    return workers
+
+def shard_key(event, shard_id):
+    return "/".join([SHARD_PREFIX, event['RequestId'], "{}.json".format(shard_id)])
+
+def save_shard_result(s3_bucket, event, status):
+    add_file_to_s3(s3_bucket, json.dumps({"status": status}), shard_key(event, event["Shard"]["Id"]),
+                   "text/json", "private")
+
+@telemetry.timed('wait_for_shards')
+def wait_for_shards(s3_bucket, event, context=None):
+    # Returns the result of every shard by key, or None when the deadline hit first
+    client = get_client('s3')
+    prefix = "/".join([SHARD_PREFIX, event['RequestId'], ""])
+    while True:
+        keys = [shard_key(event, shard_id) for shard_id in range(event["Shards"])]
+        reported = {item['Key'] for item in client.list_objects_v2(Bucket=s3_bucket, Prefix=prefix).get('Contents', [])}
+        if reported.issuperset(keys):
+            results = read_s3_objects(s3_bucket, keys)
+            if len(results) == len(keys):
+                return {key: json.loads(body) for key, body in results.items()}
+        if remaining_seconds(context) - SHARD_POLL_DELAY < WAITER_DEADLINE_MARGIN:
+            log.info("Deadline reached with {} of {} shards reported".format(len(reported), len(keys)))
+            return None
+        log.debug("Waiting on {} shards...".format(len(keys) - len(reported)))
+        time.sleep(SHARD_POLL_DELAY)
+
+class RateLimiter(object):
+    """
+    Spaces calls out to at most ``rate`` per second across all threads.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            wait = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+cf_rate_limiter = RateLimiter(CREATE_STACK_RATE)
+
+def backoff_delay(attempt):
+    # Full jitter exponential backoff
+    return random.uniform(0, min(SUBMIT_MAX_DELAY, SUBMIT_BASE_DELAY * 2 ** attempt))
+
+def classify_create_error(e, stack_name):
+    if not isinstance(e, ClientError):
+        return "retry"
+    code = e.response['Error']['Code']
+    if code in THROTTLING_ERRORS:
+        return "throttled"
+    if code == 'AlreadyExistsException':
+        stack = get_stack_cache().describe(stack_name)
+        if stack is None or stack['StackStatus'] == 'DELETE_IN_PROGRESS':
+            return "deleting"
+        return "exists"
+    if code in ('ValidationError', 'InsufficientCapabilitiesException',
+                'LimitExceededException', 'TokenAlreadyExistsException'):
+        return "fatal"
+    return "retry"
+
+@telemetry.timed('cloudformation.build_stacks')
+def build_stacks(params_array, context=None):
     # This creates a new Student environment.
-    cf_client = boto3.client("cloudformation")
-    waiting_to_build = len(params_array)
-    while waiting_to_build > 0:
-        for params in params_array:
+    # Only stacks that have not been created yet are retried. A stack whose previous
+    # incarnation is still deleting is retried until the deadline, throttled and unknown
+    # errors get SUBMIT_MAX_ATTEMPTS attempts and fatal errors are not retried at all.
+    # Returns a map of stack name to "submitted", "failed" or "pending".
+    cf_client = get_client('cloudformation')
+    pending = [{"params": params, "attempt": 0, "next_attempt": 0} for params in params_array]
+    outcome = {}
+    while pending:
+        now = time.time()
+        for entry in [p for p in pending if p["next_attempt"] <= now]:
+            stack_name = entry["params"]["StackName"]
+            cf_rate_limiter.acquire()
             try:
-                stack_result = cf_client.create_stack(**params)
-                waiting_to_build = waiting_to_build - 1
-            # Likely waiting for stack to finish deleting
+                stack_result = cf_client.create_stack(**entry["params"])
+                get_stack_cache().update(stack_name, {"StackName": stack_name,
+                                                      "StackId": stack_result["StackId"],
+                                                      "StackStatus": "CREATE_IN_PROGRESS"})
+                outcome[stack_name] = "submitted"
             except Exception as e:
-                log.error(e)
-                log.error("Previous stack not deleted yet.")
-        if waiting_to_build == 0:
+                kind = classify_create_error(e, stack_name)
+                entry["attempt"] += 1
+                if kind == "exists":
+                    log.info("Stack {} already exists".format(stack_name))
+                    outcome[stack_name] = "submitted"
+                elif kind == "fatal" or (kind != "deleting" and entry["attempt"] >= SUBMIT_MAX_ATTEMPTS):
+                    log.error("Failed to create stack {}: {}".format(stack_name, e))
+                    outcome[stack_name] = "failed"
+                else:
+                    delay = backoff_delay(min(entry["attempt"], 10))
+                    if kind == "deleting":
+                        log.info("Previous stack {} not deleted yet, retrying in {:.1f}s".format(stack_name, delay))
+                    else:
+                        log.info("Create stack {} {} ({}), retrying in {:.1f}s".format(stack_name, kind, e, delay))
+                    entry["next_attempt"] = time.time() + delay
+                    continue
+            pending.remove(entry)
+        if not pending:
             break
-        else:
-            log.info("Sleeping 20 seconds...")
-            time.sleep(20)
+        sleep = max(0, min(p["next_attempt"] for p in pending) - time.time())
+        if remaining_seconds(context) - sleep < WAITER_DEADLINE_MARGIN:
+            log.info("Deadline reached with {} stacks waiting to be created".format(len(pending)))
+            break
+        time.sleep(sleep)
+    for entry in pending:
+        outcome[entry["params"]["StackName"]] = "pending"
+    return outcome
 
+@telemetry.timed('cloudformation.delete_stack')
 def delete_stack(stack_name):
-    cf_client = boto3.client("cloudformation")
-    if stack_exists(cf_client, stack_name):
+    cf_client = get_client('cloudformation')
+    stack = get_stack_cache().get(stack_name)
+    if stack:
         try:
             log.debug("Deleting stack {}".format(stack_name))
             cf_client.delete_stack(StackName=stack_name)
+            get_stack_cache().update(stack_name, dict(stack, StackStatus='DELETE_IN_PROGRESS'))
         except Exception as e:
             log.error("Failed to delete stack {}".format(stack_name))
             log.error("Exception {}".format(e))
+            return False
+    return True
+
+@telemetry.timed('teardown')
+def teardown(stack_names, s3_bucket=None, context=None, max_concurrency=4):
+    # The bucket, when given, is emptied in the background while the stacks are deleted
+    # concurrently and waited on together. Returns the wait_for_stack_state outcome of
+    # every stack plus the bucket's outcome under its own name.
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency) + 1) as executor:
+        if s3_bucket:
+            s3_future = executor.submit(delete_contents_s3, s3_bucket, context)
+        deleted = dict(zip(stack_names, executor.map(delete_stack, stack_names)))
+        outcome = wait_for_stack_state([{"stack_name": name, "stack_state": "stack_delete_complete"}
+                                        for name in stack_names if deleted[name]], context)
+        outcome.update((name, "failed") for name in stack_names if not deleted[name])
+        if s3_bucket:
+            try:
+                outcome[s3_bucket] = s3_future.result()
+            except Exception as e:
+                log.error("Failed to empty bucket {}: {}".format(s3_bucket, e))
+                outcome[s3_bucket] = "failed"
+    return outcome
 
-def rebuild_stacks(cluster_name, failed_clusters, s3_bucket):
-    rebuild_array = []
-    waiter_array = []
-    stack_state = 'stack_delete_complete'
+def wait_for_stack_deleted(stack_name, context=None):
+    # Point lookups for a single stack, so each rebuild moves on as soon as its own
+    # delete finished. Returns the final status, or None when the deadline hit first.
+    delay = WAITER_MIN_DELAY
+    while True:
+        stack = get_stack_cache().describe(stack_name)
+        status = stack['StackStatus'] if stack else 'DELETE_COMPLETE'
+        if status in ('DELETE_COMPLETE', 'DELETE_FAILED'):
+            return status
+        if remaining_seconds(context) - delay < WAITER_DEADLINE_MARGIN:
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, WAITER_MAX_DELAY)
 
+@telemetry.timed('rebuild_stack')
+def rebuild_stack(stack_name, params, context=None):
+    # Delete, wait for the delete and recreate a single stack, retrying failed deletes
+    # up to REBUILD_DELETE_ATTEMPTS times. A delete request that is refused fails the
+    # rebuild at once instead of waiting on a stack that is not being deleted.
+    metrics = {"deletes": 0}
+    start = time.time()
+    for attempt in range(REBUILD_DELETE_ATTEMPTS):
+        metrics["deletes"] += 1
+        if not delete_stack(stack_name):
+            metrics["result"] = "failed"
+            return metrics
+        status = wait_for_stack_deleted(stack_name, context)
+        if status != 'DELETE_FAILED':
+            break
+        log.error("Delete of stack {} failed, retrying".format(stack_name))
+    metrics["delete"] = round(time.time() - start, 1)
+    if status != 'DELETE_COMPLETE':
+        metrics["result"] = "pending" if status is None else "failed"
+        return metrics
+    start = time.time()
+    metrics["result"] = build_stacks([params], context)[stack_name]
+    metrics["create"] = round(time.time() - start, 1)
+    return metrics
+
+def rebuild_stacks(cluster_name, failed_clusters, s3_bucket, context=None, max_concurrency=4):
+    # Every failed cluster gets its own delete/wait/recreate pipeline, so deletes run
+    # concurrently and each stack is recreated as soon as its own delete completed.
+    # Submitted and failed rebuilds both use up one of the student's attempts, a student
+    # without saved parameters cannot be rebuilt and is marked failed right away.
+    start = time.time()
+    state_store = get_state_store(s3_bucket)
+    students = state_store.load()
+    rebuild_clusters = []
     for student_cluster_name in failed_clusters:
-        log.info("Attempting to rebuild stack {}...".format(student_cluster_name))
-        delete_stack(student_cluster_name)
-    for student_cluster_name in failed_clusters:
-        cf_params_json = os.path.join(student_cluster_name, "cf_params.json")
-        local_cf_params_json = os.path.join("/tmp", student_cluster_name + "-cf_params.json")
-        get_from_s3(s3_bucket, cf_params_json, local_cf_params_json)
-        rebuild_array.append(json.load(open(local_cf_params_json)))
-    build_stacks(rebuild_array)
+        if students.get(student_cluster_name, {}).get("attempts", 0) >= REBUILD_MAX_ATTEMPTS:
+            log.error("Stack {} failed {} times, giving up".format(student_cluster_name, REBUILD_MAX_ATTEMPTS))
+            state_store.update(student_cluster_name, status="failed")
+            continue
+        rebuild_clusters.append(student_cluster_name)
+    if not rebuild_clusters:
+        return {}
+    cf_params = read_s3_objects(s3_bucket,
+                                [os.path.join(name, "cf_params.json") for name in rebuild_clusters],
+                                max_concurrency)
+    outcome = {}
+    with ThreadPoolExecutor(max_workers=min(len(rebuild_clusters), REBUILD_CONCURRENCY)) as executor:
+        futures = {}
+        for student_cluster_name in rebuild_clusters:
+            cf_params_json = os.path.join(student_cluster_name, "cf_params.json")
+            if cf_params_json not in cf_params:
+                log.error("No saved parameters for {}, unable to rebuild".format(student_cluster_name))
+                state_store.update(student_cluster_name, status="failed")
+                outcome[student_cluster_name] = "failed"
+                continue
+            log.info("Attempting to rebuild stack {}...".format(student_cluster_name))
+            futures[executor.submit(run_for_student, student_cluster_name, rebuild_stack, student_cluster_name,
+                                    json.loads(cf_params[cf_params_json]), context)] = student_cluster_name
+        for future in as_completed(futures):
+            student_cluster_name = futures[future]
+            try:
+                metrics = future.result()
+            except Exception as e:
+                log.error("Failed to rebuild {}: {}".format(student_cluster_name, e))
+                metrics = {"result": "failed"}
+            log.info("Rebuild {}: {}".format(student_cluster_name, metrics))
+            outcome[student_cluster_name] = metrics["result"]
+            if metrics["result"] == "submitted":
+                state_store.update(student_cluster_name, attempt=True, status="building", started=time.time())
+            elif metrics["result"] == "failed":
+                student = state_store.update(student_cluster_name, attempt=True)
+                if student["attempts"] >= REBUILD_MAX_ATTEMPTS:
+                    log.error("Stack {} failed {} times, giving up".format(student_cluster_name, REBUILD_MAX_ATTEMPTS))
+                    state_store.update(student_cluster_name, status="failed")
+    log.info("Rebuilt {} stacks in {:.1f}s: {}".format(len(outcome), time.time() - start, outcome))
+    return outcome
+
+def validate_clusters(stack_arr, s3_bucket, openshift_version, max_concurrency):
+    # Probe every unfinished cluster that could be up by now in parallel, then scale the
+    # reachable ones down concurrently. Each stack gets the time it should be checked
+    # again in "next_check". Returns the clusters that need to be rebuilt.
+    start = time.time()
+    failed_clusters = []
+    pending = []
+    for stack in stack_arr:
+        if stack["status"] == "complete":
+            log.debug("Stack complete {}".format(stack["name"]))
+            continue
+        if stack["status"] == "failed":
+            log.debug("Stack out of rebuild attempts {}".format(stack["name"]))
+            continue
+        if not stack["status"]:
+            # Not submitted yet, a Create continuation or shard worker still owns it
+            log.debug("Stack not created yet {}".format(stack["name"]))
+            stack["next_check"] = start + VALIDATE_INSTALL_TIME
+            continue
+        # If its OpenShift 3, add as a Failed.
+        if openshift_version == "3":
+            log.debug("Stack failed {}".format(stack["name"]))
+            failed_clusters.append(stack["name"])
+            stack["next_check"] = start + VALIDATE_INSTALL_TIME
+            continue
+        # Migrated records have neither a start nor a created time, they are due now
+        ready_by = stack["started"] + VALIDATE_INSTALL_TIME if stack.get("started") else start
+        if ready_by > start:
+            log.debug("Stack {} installing for another {:.0f}s".format(stack["name"], ready_by - start))
+            stack["next_check"] = ready_by
+            continue
+        pending.append(stack)
+    probes = probe_clusters(pending)
+    log.info("Cluster probes: {}".format(probes))
+    reachable = []
+    for stack in pending:
+        probe = probes[stack["name"]]
+        if probe == "reachable":
+            reachable.append(stack)
+            continue
+        cf_stack = get_stack_cache().get(stack["name"])
+        if cf_stack and cf_stack["StackStatus"] == "CREATE_IN_PROGRESS":
+            log.debug("Stack still creating {}".format(stack["name"]))
+            stack["next_check"] = next_validation(stack, probe, start)
+            continue
+        failed_clusters.append(stack["name"])
+        stack["next_check"] = start + VALIDATE_INSTALL_TIME
+    if reachable:
+        with ThreadPoolExecutor(max_workers=min(len(reachable), max(1, max_concurrency))) as executor:
+            futures = {executor.submit(run_for_student, stack["name"], scale_ocp_replicas,
+                                       s3_bucket, stack["name"], stack["status"]): stack
+                       for stack in reachable}
+            for future in as_completed(futures):
+                stack = futures[future]
+                result = future.result()
+                if result == "complete":
+                    stack["status"] = "complete"
+                elif result == "retry":
+                    stack["next_check"] = start + VALIDATE_MIN_INTERVAL
+                else:
+                    log.debug("Stack failed {}".format(stack["name"]))
+                    failed_clusters.append(stack["name"])
+                    stack["next_check"] = start + VALIDATE_INSTALL_TIME
+    log.info("Validated {} clusters in {:.1f}s".format(len(pending), time.time() - start))
+    return failed_clusters
 
+def next_validation(stack, probe, now):
+    # A cluster whose API name resolves is minutes away from answering. Without a DNS
+    # record the install is still early, the interval then grows with the time spent
+    # past VALIDATE_INSTALL_TIME, so it roughly doubles on every check.
+    if probe != "dns-missing":
+        return now + VALIDATE_MIN_INTERVAL
+    overdue = now - (stack.get("started") or now) - VALIDATE_INSTALL_TIME
+    return now + min(VALIDATE_MAX_INTERVAL, max(VALIDATE_MIN_INTERVAL, overdue))
+
+def deploy_student(stack, cf_params, openshift_install_binary, download_path, ssh_key,
+                   pull_secret, hosted_zone_name, s3_bucket, openshift_version,
+                   create_cloud9_instance, context=None):
+    # Each student gets its own copy of the parameters and its own assets directory so
+    # workers never share mutable state.
+    timings = {}
+    student_cluster_name = stack["name"]
+    local_student_folder = download_path + student_cluster_name
+    student_cf_params = copy.deepcopy(cf_params)
+    log.debug("STACK: {}".format(stack))
+    start = time.time()
+    if openshift_version != "3":
+        config_digest = install_config_digest(
+            render_install_config(student_cluster_name, ssh_key, pull_secret,
+                                  hosted_zone_name, stack["networks"]))
+        # One listing serves both the cache check and the upload comparison
+        stored = list_s3_etags(s3_bucket, student_cluster_name + '/')
+        if ignition_bundle_cached(s3_bucket, student_cluster_name, config_digest, stored):
+            log.info("Ignition files for {} already in S3, skipping installer".format(student_cluster_name))
+        else:
+            generate_ignition_files(openshift_install_binary, download_path,
+                                    student_cluster_name, ssh_key, pull_secret,
+                                    hosted_zone_name, networks=stack["networks"])
+            timings["ignition"] = time.time() - start
+            start = time.time()
+            sync_ignition_files(local_student_folder, s3_bucket, stored=stored)
+            save_ignition_cache(s3_bucket, student_cluster_name, config_digest)
+            timings["upload"] = time.time() - start
+        start = time.time()
+    save_cfparams_json(cf_params=student_cf_params,
+                       s3_bucket=s3_bucket,
+                       student_cluster_name=student_cluster_name,
+                       create_cloud9_instance=create_cloud9_instance)
+    timings["cf_params"] = time.time() - start
+    start = time.time()
+    outcome = build_stacks([student_cf_params], context)
+    if outcome[student_cluster_name] == "pending":
+        # The previous stack is still deleting at the deadline, the follow-up
+        # invocation creates it
+        log.info("Stack {} still pending at the deadline, deferring it".format(student_cluster_name))
+        return None
+    if outcome[student_cluster_name] != "submitted":
+        raise Exception("Stack {} was not created: {}".format(student_cluster_name, outcome[student_cluster_name]))
+    timings["create_stack"] = time.time() - start
+    stack["status"] = "building"
+    local_kubeadmin_file = os.path.join(local_student_folder, KUBEADMIN_PASSWORD_FILE)
+    if os.path.exists(local_kubeadmin_file):
+        stack["kubeadmin_password"] = open(local_kubeadmin_file).read()
+    else:
+        stack["kubeadmin_password"] = get_kubeadmin_pass(s3_bucket, student_cluster_name)
+    get_state_store(s3_bucket).update(student_cluster_name, attempt=True, status="building",
+                                      started=time.time(),
+                                      kubeadmin_password=stack["kubeadmin_password"],
+                                      api_url=stack.get("api_url"),
+                                      console_url=stack["console_url"])
+    return timings
+
+def deploy_students(stacks, cf_params, openshift_install_binary, download_path, ssh_key,
+                    pull_secret, hosted_zone_name, s3_bucket, openshift_version,
+                    create_cloud9_instance, max_concurrency, context=None):
+    # Students are independent, so the installer runs, S3 uploads and create_stack calls
+    # of different students overlap, bounded by max_concurrency workers.
+    # A student is only started when there is enough Lambda time left to finish it, the
+    # rest are returned so a follow-up invocation can pick them up.
+    failed = []
+    deferred = []
+    budget = {"student": CREATE_STUDENT_BUDGET}
+    budget_lock = threading.Lock()
+
+    def deploy(stack):
+        if remaining_seconds(context) < budget["student"] + WAITER_DEADLINE_MARGIN:
+            return None
+        with telemetry.student(stack["name"]):
+            timings = deploy_student(stack, cf_params, openshift_install_binary, download_path,
+                                     ssh_key, pull_secret, hosted_zone_name, s3_bucket,
+                                     openshift_version, create_cloud9_instance, context)
+        if timings is not None:
+            with budget_lock:
+                budget["student"] = max(budget["student"], sum(timings.values()))
+        return timings
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = {executor.submit(deploy, stack): stack for stack in stacks}
+        for future in as_completed(futures):
+            student_cluster_name = futures[future]["name"]
+            try:
+                timings = future.result()
+                if timings is None:
+                    deferred.append(student_cluster_name)
+                    continue
+                log.info("Deployed {} in {:.1f}s: {}".format(
+                    student_cluster_name, sum(timings.values()),
+                    ", ".join("{}={:.1f}s".format(k, v) for k, v in timings.items())))
+            except Exception as e:
+                log.error("Failed to deploy {}: {}".format(student_cluster_name, e))
+                failed.append(student_cluster_name)
+    if failed:
+        raise Exception("Failed to deploy students: {}".format(", ".join(failed)))
+    if deferred:
+        log.info("Deferred {} students to a follow-up invocation".format(len(deferred)))
+    return deferred
+
+def get_template(name):
+    # Compiled templates are kept for the lifetime of the Lambda container, the files
+    # ship with the function so they are never checked for changes
+    global template_env
+    if name not in templates:
+        if template_env is None:
+            import jinja2
+            template_env = jinja2.Environment(loader=jinja2.FileSystemLoader("./templates"), auto_reload=False)
+        templates[name] = template_env.get_template(name)
+    return templates[name]
+
+def render_student_rows(cluster_data, stack_arr):
+    # Only students whose details changed since the last render are rendered again
+    template = get_template("student.j2")
+    rows = []
+    for stack in stack_arr:
+        fragment_key = json.dumps([cluster_data, stack], sort_keys=True, default=str)
+        cached = student_fragments.get(stack["name"])
+        if cached is None or cached[0] != fragment_key:
+            cached = (fragment_key, template.render(cluster=cluster_data, stack=stack))
+            student_fragments[stack["name"]] = cached
+        rows.append(cached[1])
+    return rows
+
+@telemetry.timed('generate_webtemplate')
 def generate_webtemplate(s3_bucket, cluster_data, stack_arr):
     try:
         log.debug("Generating workshop webpage")
-        j2Env = jinja2.Environment(loader = jinja2.FileSystemLoader("./templates"))
-        template = j2Env.get_template("clusters.j2")
-        rendered_text = template.render(cluster=cluster_data, stack_arr=stack_arr)
+        template = get_template("clusters.j2")
+        rendered_text = template.render(cluster=cluster_data,
+                                        student_rows=render_student_rows(cluster_data, stack_arr))
+        # Non multipart uploads have the MD5 of the body as their ETag. Other invocations
+        # upload the page too, so it is compared with the copy in S3 and not the last
+        # one this container uploaded.
+        etag = '"{}"'.format(hashlib.md5(rendered_text.encode('utf-8')).hexdigest())
+        try:
+            stored_etag = get_client('s3').head_object(Bucket=s3_bucket, Key="workshop.html")['ETag']
+        except ClientError:
+            stored_etag = None
+        if etag == stored_etag:
+            log.debug("Workshop webpage unchanged, skipping upload")
+            return
         add_file_to_s3(s3_bucket=s3_bucket,body=rendered_text,
                         key="workshop.html", content_type="text/html",
                         acl="public-read")
     except Exception as e:
         log.error("Exception caught generating webtemplate: {}".format(e))
 
+def get_config():
+    # The environment of a Lambda container never changes, it is parsed once
+    global config
+    if config is None:
+        config = {"log_level": logging.getLevelName(os.getenv('LogLevel')),
+                  "s3_bucket": os.getenv('AuthBucket'),
+                  "cluster_name": os.getenv('ClusterName'),
+                  "number_of_students": int(os.getenv('NumStudents')),
+                  "hosted_zone_name": os.getenv('HostedZoneName'),
+                  "openshift_client_base_mirror_url": os.getenv('OpenShiftMirrorURL'),
+                  "openshift_version": os.getenv('OpenShiftVersion'),
+                  "openshift_install_binary": os.getenv('OpenShiftInstallBinary'),
+                  "create_cloud9_instance": decide_cloud9(os.getenv("CreateCloud9Instance")),
+                  "max_concurrency": int(os.getenv('MaxConcurrency', 4)),
+                  "students_per_worker": int(os.getenv('StudentsPerWorker', 0)),
+                  "vpc_cidr": os.getenv('VPCCIDR'),
+                  "pull_secret": os.getenv('PullSecret'),
+                  "ssh_key": os.getenv('SSHKey')}
+    return config
+
 def handler(event, context):
     status = cfnresponse.SUCCESS
-    level = logging.getLevelName(os.getenv('LogLevel'))
-    log.setLevel(level)
+    settings = get_config()
+    log.setLevel(settings["log_level"])
+    # kube_scaler logs through its own logger, configured before it is imported
+    logging.getLogger('kube_scaler').setLevel(settings["log_level"])
     log.debug(event)
-    s3_bucket = os.getenv('AuthBucket')
-    cluster_name = os.getenv('ClusterName')
-    number_of_students = int(os.getenv('NumStudents'))
-    hosted_zone_name = os.getenv('HostedZoneName')
-    openshift_client_base_mirror_url = os.getenv('OpenShiftMirrorURL')
-    openshift_version = os.getenv('OpenShiftVersion')
-    openshift_client_binary = os.getenv('OpenShiftClientBinary')
-    openshift_install_binary = os.getenv('OpenShiftInstallBinary')
-    create_cloud9_instance = decide_cloud9(os.getenv("CreateCloud9Instance"))
+    reset_s3_request_count()
+    telemetry.reset()
+    reset_stack_cache()
+    reset_state_store()
+    event = set_request_deadline(event)
+    set_process_deadline(context)
+    s3_bucket = settings["s3_bucket"]
+    cluster_name = settings["cluster_name"]
+    number_of_students = settings["number_of_students"]
+    hosted_zone_name = settings["hosted_zone_name"]
+    openshift_client_base_mirror_url = settings["openshift_client_base_mirror_url"]
+    openshift_version = settings["openshift_version"]
+    openshift_install_binary = settings["openshift_install_binary"]
+    create_cloud9_instance = settings["create_cloud9_instance"]
+    max_concurrency = settings["max_concurrency"]
+    students_per_worker = settings["students_per_worker"]
+    vpc_cidr = settings["vpc_cidr"]
+    # Shard workers only handle their own students, the orchestrator answers CloudFormation
+    shard = event.get('Shard')
+    orchestrate = shard is None and event.get('RequestType') in ('Create', 'Delete') \
+        and 0 < students_per_worker < number_of_students
     file_extension = '.tar.gz'
     cluster_data = {"cluster_name": cluster_name,
                     "openshift_version": openshift_version,
                     "clusters_information": {} }
-    stack_arr = {}
-    if not event.get('RequestType') == 'Delete':
-        stack_arr = build_stack_arr(cluster_name,
-                                    number_of_students,
-                                    hosted_zone_name,
-                                    create_cloud9_instance,
-                                    s3_bucket,
-                                    openshift_version)
-        generate_webtemplate(s3_bucket, cluster_data, stack_arr)
     if sys.platform == 'darwin':
         openshift_install_os = '-mac-'
     else:
         openshift_install_os = '-linux-'
-    openshift_client_package = openshift_client_binary + openshift_install_os + openshift_version + file_extension
     openshift_client_mirror_url = openshift_client_base_mirror_url + openshift_version + "/"
     download_path = '/tmp/'
-    log.info("Cluster name: " + os.getenv('ClusterName'))
+    log.info("Cluster name: " + cluster_name)
     # We are in the Deploy CloudFormation event
     if 'RequestType' in event.keys():
+        handed_off = False
+        workers = None
         try:
-            if event['RequestType'] == 'Delete':
-                waiter_array = []
-                wait_for_state = "stack_delete_complete"
-                log.info("Deleting all student stacks in {} deployment'.format(cluster_name)")
-                delete_contents_s3(s3_bucket=s3_bucket)
-                for i in range(number_of_students):
-                    student_cluster_name = cluster_name + '-' + 'student' + str(i)
-                    delete_stack(student_cluster_name)
-                    waiter_array.append({
-                        "stack_name": student_cluster_name,
-                        "stack_state": wait_for_state })
-                # TODO: If the stack is in state other than 'DELETE_IN_PROGRESS' then the lambda will timeout waiting on
-                # 'stack_delete_complete' state
-                wait_for_stack_state(waiter_array)
+            # Inside the try so a failed state read still answers CloudFormation or the
+            # orchestrator. Validate runs read the students once they hold the lease.
+            if event['RequestType'] == 'Create':
+                stack_arr = build_stack_arr(cluster_name,
+                                            number_of_students,
+                                            hosted_zone_name,
+                                            create_cloud9_instance,
+                                            s3_bucket,
+                                            openshift_version)
+                if shard:
+                    stack_arr = [stack for stack in stack_arr if stack["number"] in shard["Students"]]
+                else:
+                    generate_webtemplate(s3_bucket, cluster_data, stack_arr)
+            if orchestrate:
+                if "Shards" not in event:
+                    if event['RequestType'] == 'Create' and openshift_version != "3":
+                        # A class that does not fit the address space fails before any
+                        # worker starts, the workers read the saved plan
+                        load_network_plan(s3_bucket, number_of_students, vpc_cidr)
+                        # Fills the artifact cache the workers install from
+                        install_dependencies(openshift_client_mirror_url,
+                                             openshift_install_binary + openshift_install_os
+                                             + openshift_version + file_extension,
+                                             openshift_install_binary,
+                                             download_path,
+                                             s3_bucket)
+                    shards = plan_shards(number_of_students, students_per_worker)
+                    workers = dispatch_shards(event, shards, context)
+                    event = dict(event, Shards=len(shards))
+                results = wait_for_shards(s3_bucket, event, context)
+                if results is None:
+                    handed_off = hand_off(event, context)
+                    if not handed_off:
+                        status = cfnresponse.FAILED
+                elif any(result["status"] != cfnresponse.SUCCESS for result in results.values()):
+                    log.error("Shard results: {}".format(results))
+                    status = cfnresponse.FAILED
+                elif event['RequestType'] == 'Delete':
+                    # The shard results go with the rest of the bucket, a continuation
+                    # only has the bucket left to empty
+                    if delete_contents_s3(s3_bucket, context) == "pending":
+                        handed_off = hand_off(dict(event, Shards=0), context)
+                        if not handed_off:
+                            status = cfnresponse.FAILED
+                else:
+                    delete_objects_s3(s3_bucket, [{'Key': key} for key in results])
+                    reset_state_store()
+                    stack_arr = build_stack_arr(cluster_name, number_of_students, hosted_zone_name,
+                                                create_cloud9_instance, s3_bucket, openshift_version)
+                    generate_webtemplate(s3_bucket, cluster_data, stack_arr)
+            elif event['RequestType'] == 'Delete':
+                log.info("Deleting all student stacks in {} deployment".format(cluster_name))
+                if shard:
+                    outcome = teardown([cluster_name + '-' + 'student' + str(i) for i in shard["Students"]],
+                                       None, context, max_concurrency)
+                else:
+                    outcome = teardown([cluster_name + '-' + 'student' + str(i) for i in range(number_of_students)],
+                                       s3_bucket, context, max_concurrency)
+                log.info("Delete outcome: {}".format(outcome))
+                if "pending" in outcome.values():
+                    handed_off = hand_off(event, context)
+                    if not handed_off:
+                        status = cfnresponse.FAILED
+                elif "failed" in outcome.values():
+                    status = cfnresponse.FAILED
             elif event['RequestType'] == 'Update':
                 log.info("Update sent, however, this is unsupported at this time.")
                 pass
             else:
-                cf_client = boto3.client('cloudformation')
                 cf_params = parse_properties(event['ResourceProperties'])
                 log.info("Delete and Update not detected, proceeding with Create")
-                pull_secret = os.environ.get('PullSecret')
-                ssh_key = os.environ.get('SSHKey')
+                pull_secret = settings["pull_secret"]
+                ssh_key = settings["ssh_key"]
                 if openshift_version != "3":
                     openshift_install_package = openshift_install_binary \
                                                 + openshift_install_os \
                                                 + openshift_version \
                                                 + file_extension
+                    networks = load_network_plan(s3_bucket, number_of_students, vpc_cidr)
+                    for stack in stack_arr:
+                        stack["networks"] = networks[str(stack["number"])]
                     log.info("Generating OCP installation files for cluster " + cluster_name)
                     install_dependencies(openshift_client_mirror_url,
                                          openshift_install_package,
                                          openshift_install_binary,
-                                         download_path)
-                for stack in stack_arr:
-                    # The only status is either building or complete, skip if either is found
-                    if stack["status"]:
-                       continue
-                    build_array = []
-                    log.debug("STACK: {}".format(stack))
-                    student_cluster_name = stack["name"]
-                    building_key = os.path.join(student_cluster_name, "building")
-                    local_student_folder = download_path + student_cluster_name
-                    if openshift_version != "3":
-                        generate_ignition_files(openshift_install_binary, download_path,
-                                                student_cluster_name, ssh_key, pull_secret,
-                                                hosted_zone_name, student_num=stack["number"])
-                        upload_ignition_files_to_s3(local_student_folder, s3_bucket)
-                    save_cfparams_json(cf_params=cf_params,
-                                       s3_bucket=s3_bucket,
-                                       student_cluster_name=student_cluster_name,
-                                       create_cloud9_instance=create_cloud9_instance)
-                    cf_params["StackName"] = stack["name"]
-                    build_array.append(cf_params)
-                    log.debug(build_array)
-                    build_stacks(build_array)
-                    stack["status"] = "building"
-                    add_file_to_s3(s3_bucket=s3_bucket,body="building",key=building_key,
-                                    content_type="text/plain", acl="private")
-                generate_webtemplate(s3_bucket, cluster_data, stack_arr)
+                                         download_path,
+                                         s3_bucket)
+                # The only status is either building or complete, skip if either is found
+                pending_stacks = [stack for stack in stack_arr if not stack["status"]]
+                deferred = deploy_students(pending_stacks, cf_params, openshift_install_binary,
+                                           download_path, ssh_key, pull_secret, hosted_zone_name,
+                                           s3_bucket, openshift_version, create_cloud9_instance,
+                                           max_concurrency, context)
+                if not shard:
+                    generate_webtemplate(s3_bucket, cluster_data, stack_arr)
+                # Progress is checkpointed in the state document, the follow-up invocation
+                # only sees the students that are still missing and answers CloudFormation
+                # once all of them are submitted.
+                if deferred:
+                    handed_off = hand_off(event, context)
+                    if not handed_off:
+                        status = cfnresponse.FAILED
             log.info("Complete")
         except Exception:
             logging.error('Unhandled exception', exc_info=True)
             status = cfnresponse.FAILED
         finally:
-            cfnresponse.send(event, context, status, {}, None)
+            log.info("S3 requests: {}".format(s3_request_count))
+            log_stack_cache_stats()
+            telemetry.emit({"ClusterName": cluster_name, "RequestType": event.get('RequestType', 'Validate')})
+            if workers:
+                workers.shutdown()
+            if not handed_off:
+                if shard:
+                    save_shard_result(s3_bucket, event, status)
+                else:
+                    cfnresponse.send(event, context, status, {}, None)
     # We are in the Validate openshift clusters event
     else:
+        lease_owner = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
         try:
-            if openshift_version != "3":
-                install_dependencies(openshift_client_mirror_url,
-                                     openshift_client_package,
-                                     openshift_client_binary,
-                                     download_path)
-            failed_clusters = []
-            for stack in stack_arr:
-                if stack["status"] == "complete":
-                    log.debug("Stack complete {}".format(stack["name"]))
-                    continue
-                # If its OpenShift 3, add as a Failed.
-                # If it is not available,add to array and continue - Is this needed?
-                # Otherwise it is available and OCP 4 so test.
-                # If successful, continue, otherwise append to failed clusters
-                if openshift_version != "3":
-                    if not cluster_availabe(url=stack["api_url"]):
-                        failed_clusters.append(stack["name"])
-                        continue
-                    if scale_ocp_replicas(s3_bucket, stack["name"], stack["status"]):
-                        stack["status"] = "complete"
-                        continue
-                log.debug("Stack failed {}".format(stack["name"]))
-                failed_clusters.append(stack["name"])
-            generate_webtemplate(s3_bucket, cluster_data, stack_arr)
-            if len(failed_clusters) == 0:
-                deactivate_event(cluster_name)
-            else:
-                log.debug("failed_clusters = {}".format(failed_clusters))
-                rebuild_stacks(cluster_name, failed_clusters, s3_bucket)
-            log.info("Complete")
+            # A rebuild keeps a run waiting on deletes for most of the Lambda timeout,
+            # the lease expires with the invocation if it never gets released
+            if not get_state_store(s3_bucket).lease(VALIDATE_LEASE, lease_owner, min(remaining_seconds(context), VALIDATE_LEASE_TIME)):
+                log.info("Another Validate run is in progress, skipping")
+                return
+            try:
+                # Taking the lease read the state document, the students come from that copy
+                stack_arr = build_stack_arr(cluster_name, number_of_students, hosted_zone_name,
+                                            create_cloud9_instance, s3_bucket, openshift_version)
+                # The page only changes with a student's status, runs that change none
+                # leave it, and jinja2, alone
+                statuses = [stack["status"] for stack in stack_arr]
+                failed_clusters = validate_clusters(stack_arr, s3_bucket, openshift_version, max_concurrency)
+                if [stack["status"] for stack in stack_arr] != statuses:
+                    generate_webtemplate(s3_bucket, cluster_data, stack_arr)
+                if failed_clusters:
+                    log.debug("failed_clusters = {}".format(failed_clusters))
+                    rebuild_stacks(cluster_name, failed_clusters, s3_bucket, context, max_concurrency)
+                    # Students that ran out of attempts no longer keep the event scheduled
+                    students = get_state_store(s3_bucket).load()
+                    gave_up = [stack for stack in stack_arr if stack["status"] != "failed"
+                               and students.get(stack["name"], {}).get("status") == "failed"]
+                    for stack in gave_up:
+                        stack["status"] = "failed"
+                    if gave_up:
+                        generate_webtemplate(s3_bucket, cluster_data, stack_arr)
+                schedule_validate_event(cluster_name, stack_arr)
+                log.info("Complete")
+            finally:
+                get_state_store(s3_bucket).lease(VALIDATE_LEASE, lease_owner, 0)
         except Exception:
             logging.error('Unhandled exception', exc_info=True)
+        finally:
+            log.info("S3 requests: {}".format(s3_request_count))
+            log_stack_cache_stats()
+            telemetry.emit({"ClusterName": cluster_name, "RequestType": event.get('RequestType', 'Validate')})
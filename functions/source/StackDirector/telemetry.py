@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Read once at import, when disabled the decorators hand back the undecorated
+# functions so instrumentation costs nothing.
+enabled = os.getenv('Telemetry', 'enabled') == 'enabled'
+
+NAMESPACE = 'StackDirector'
+
+lock = threading.Lock()
+local = threading.local()
+operations = {}
+students = {}
+
+
+def reset():
+    with lock:
+        operations.clear()
+        students.clear()
+
+
+def current_student():
+    return getattr(local, 'student', None)
+
+
+@contextmanager
+def student(name):
+    # Attribute every call made by this thread to a student
+    previous = current_student()
+    local.student = name
+    try:
+        yield
+    finally:
+        local.student = previous
+
+
+def record(operation, seconds, nbytes=0, error=False):
+    name = current_student()
+    with lock:
+        targets = [operations.setdefault(operation, new_stats())]
+        if name:
+            targets.append(students.setdefault(name, {}).setdefault(operation, new_stats()))
+        for stats in targets:
+            stats["count"] += 1
+            stats["errors"] += int(error)
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["bytes"] += nbytes
+
+
+def new_stats():
+    return {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0}
+
+
+def timed(operation, size=None):
+    """
+    Records latency and call count of the decorated function under ``operation``.
+    ``size`` is called with the result and the call arguments to count bytes.
+    """
+    def decorator(func):
+        if not enabled:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            error = True
+            nbytes = 0
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                if size is not None:
+                    nbytes = size(result, *args, **kwargs) or 0
+                return result
+            finally:
+                record(operation, time.time() - start, nbytes, error)
+        return wrapper
+    return decorator
+
+
+def summary():
+    with lock:
+        return {"operations": json.loads(json.dumps(operations)),
+                "students": json.loads(json.dumps(students))}
+
+
+def emit(dimensions):
+    """
+    Prints one CloudWatch Embedded Metric Format line per operation followed by a
+    JSON summary with the per student breakdown.
+    """
+    if not enabled:
+        return
+    data = summary()
+    timestamp = int(time.time() * 1000)
+    dimension_names = sorted(dimensions) + ["Operation"]
+    for operation, stats in sorted(data["operations"].items()):
+        line = {"_aws": {"Timestamp": timestamp,
+                         "CloudWatchMetrics": [{"Namespace": NAMESPACE,
+                                                "Dimensions": [dimension_names],
+                                                "Metrics": [{"Name": "Latency", "Unit": "Milliseconds"},
+                                                            {"Name": "Calls", "Unit": "Count"},
+                                                            {"Name": "Errors", "Unit": "Count"},
+                                                            {"Name": "Bytes", "Unit": "Bytes"}]}]},
+                "Operation": operation,
+                "Latency": round(stats["seconds"] * 1000, 1),
+                "Calls": stats["count"],
+                "Errors": stats["errors"],
+                "Bytes": stats["bytes"]}
+        line.update(dimensions)
+        print(json.dumps(line))
+    print(json.dumps({"telemetry": data}))
@@ -0,0 +1,427 @@
+"""
+Offline benchmarks for the StackDirector Lambda.
+
+No AWS account is needed: AWS calls are answered by a botocore Stubber or by moto,
+the OpenShift installer is replaced by a fake served from a local mirror and the
+cluster APIs are simulated by a local fake Kubernetes API server.
+Usage:
+    python functions/tests/benchmark.py clients [iterations]
+    python functions/tests/benchmark.py handler [students...]
+    python functions/tests/benchmark.py shards [students] [students per worker...]
+    python functions/tests/benchmark.py imports [iterations]
+
+The imports benchmark measures the cold start of lambda_handler in fresh interpreters:
+module import time, the modules it loads up front and the first versus warm cost of
+the install-config and template caches.
+
+The handler benchmark runs Create, Validate and Delete for each class size
+(default 1 10 50 100) and needs moto. These environment variables tune the fakes:
+    FAKE_INSTALLER_LATENCY  seconds per openshift-install run (default 0.5)
+    FAKE_KUBE_LATENCY       seconds per Kubernetes API request (default 0.01)
+    FAKE_PROBE_LATENCY      seconds per cluster API probe (default 0.05)
+    BENCH_LOG_LEVEL         LogLevel of the handler (default ERROR)
+    BENCH_VERBOSE           print the API calls made in each phase
+"""
+import hashlib
+import json
+import statistics
+import subprocess
+import logging
+import os
+import resource
+import shutil
+import socket
+import sys
+import tarfile
+import tempfile
+import time
+import threading
+import tracemalloc
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+from botocore.stub import Stubber
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source', 'StackDirector')
+sys.path.insert(0, SOURCE_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+# The telemetry lines would drown the results table, set Telemetry=enabled to see them
+os.environ.setdefault('Telemetry', 'disabled')
+
+import lambda_handler
+import cfnresponse
+import kube_scaler
+from ruamel import yaml
+
+CLUSTER_NAME = 'bench'
+OPENSHIFT_VERSION = '4.6'
+AUTH_BUCKET = 'bench-auth'
+TEMPLATE_BUCKET = 'bench-templates'
+DOWNLOAD_PATH = '/tmp/'
+
+FAKE_INSTALLER = '''#!/usr/bin/env python3
+import json, os, re, sys, time
+directory = sys.argv[sys.argv.index('--dir') + 1].rstrip('/')
+time.sleep(float(os.getenv('FAKE_INSTALLER_LATENCY', '0.5')))
+install_config = os.path.join(directory, 'install-config.yaml')
+domain = re.search(r'"baseDomain": "([^"]+)"', open(install_config).read()).group(1)
+name = os.path.basename(directory)
+os.makedirs(os.path.join(directory, 'auth'), exist_ok=True)
+for ignition in ('bootstrap.ign', 'master.ign', 'worker.ign'):
+    json.dump({"ignition": {"version": "3.1.0"}}, open(os.path.join(directory, ignition), 'w'))
+with open(os.path.join(directory, 'auth', 'kubeconfig'), 'w') as kubeconfig:
+    kubeconfig.write("clusters:\\n- cluster:\\n    server: https://api.{}.{}:6443\\n  name: {}\\n".format(name, domain, name))
+    kubeconfig.write("users:\\n- name: admin\\n  user:\\n    token: fake-token\\n")
+with open(os.path.join(directory, 'auth', 'kubeadmin-password'), 'w') as password:
+    password.write('fake-kubeadmin-password')
+os.remove(install_config)
+'''
+
+STUDENT_TEMPLATE = '''AWSTemplateFormatVersion: "2010-09-09"
+Parameters:
+  HostedZoneName:
+    Type: String
+Resources:
+  Topic:
+    Type: AWS::SNS::Topic
+'''
+
+
+def stubbed_head_object(client, bucket, key):
+    with Stubber(client) as stubber:
+        stubber.add_response('head_object', {}, {'Bucket': bucket, 'Key': key})
+        client.head_object(Bucket=bucket, Key=key)
+
+
+def benchmark_clients(iterations=200):
+    bucket = 'benchmark-bucket'
+    start = time.perf_counter()
+    for i in range(iterations):
+        stubbed_head_object(boto3.client('s3'), bucket, 'student{}/building'.format(i))
+    per_call = time.perf_counter() - start
+
+    lambda_handler.clients.clear()
+    start = time.perf_counter()
+    for i in range(iterations):
+        stubbed_head_object(lambda_handler.get_client('s3'), bucket, 'student{}/building'.format(i))
+    shared = time.perf_counter() - start
+
+    print("{} head_object calls".format(iterations))
+    print("  new client per call: {:.3f}s ({:.2f}ms/call)".format(per_call, per_call * 1000 / iterations))
+    print("  shared client:       {:.3f}s ({:.2f}ms/call)".format(shared, shared * 1000 / iterations))
+    print("  speedup:             {:.1f}x".format(per_call / shared))
+
+
+def build_fake_mirror(mirror_dir):
+    version_dir = os.path.join(mirror_dir, OPENSHIFT_VERSION)
+    os.makedirs(version_dir)
+    sums = []
+    binary_path = os.path.join(version_dir, 'openshift-install')
+    with open(binary_path, 'w') as file:
+        file.write(FAKE_INSTALLER)
+    os.chmod(binary_path, 0o755)
+    package = 'openshift-install-linux-{}.tar.gz'.format(OPENSHIFT_VERSION)
+    with tarfile.open(os.path.join(version_dir, package), 'w:gz') as tar:
+        tar.add(binary_path, arcname='openshift-install')
+    os.remove(binary_path)
+    sha256sum = hashlib.sha256(open(os.path.join(version_dir, package), 'rb').read()).hexdigest()
+    sums.append("{}  {}".format(sha256sum, package))
+    with open(os.path.join(version_dir, 'sha256sum.txt'), 'w') as file:
+        file.write("\n".join(sums) + "\n")
+
+
+class FakeKubeAPI(BaseHTTPRequestHandler):
+    """
+    Answers the requests of kube_scaler like a freshly installed cluster would: every
+    namespace has one deployment and one statefulset running one replica.
+    """
+    protocol_version = 'HTTP/1.1'
+    requests = Counter()
+
+    def reply(self):
+        time.sleep(float(os.getenv('FAKE_KUBE_LATENCY', '0.01')))
+        path = self.path.split('?')[0]
+        self.requests[self.command] += 1
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.command == 'GET' and path.endswith(('/deployments', '/statefulsets')):
+            body = {"items": [{"metadata": {"name": "workload"}, "spec": {"replicas": 1}}]}
+        elif self.command == 'GET' and path.endswith('/pods'):
+            body = {"items": []}
+        else:
+            body = {}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_PATCH = do_DELETE = reply
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_kube_api():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeKubeAPI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fake_scale_down(server, scale_down):
+    # Point the kubeconfigs generated by the fake installer at the fake API server
+    def wrapper(kubeconfig, **kwargs):
+        config = yaml.safe_load(kubeconfig)
+        config['clusters'][0]['cluster']['server'] = 'http://127.0.0.1:{}'.format(server.server_port)
+        return scale_down(json.dumps(config), **kwargs)
+    return wrapper
+
+
+class FakeContext(object):
+    log_stream_name = 'benchmark'
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:benchmark'
+
+    def __init__(self, timeout=900):
+        self.deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+
+def fake_probe_cluster(url, timeout=None):
+    time.sleep(float(os.getenv('FAKE_PROBE_LATENCY', '0.05')))
+    return "reachable"
+
+
+def reset_handler_state():
+    lambda_handler.clients.clear()
+    lambda_handler.account_id = None
+    lambda_handler.student_fragments.clear()
+    lambda_handler.config = None
+    for path in os.listdir(DOWNLOAD_PATH):
+        if path.startswith(CLUSTER_NAME + '-student'):
+            shutil.rmtree(os.path.join(DOWNLOAD_PATH, path), ignore_errors=True)
+
+
+def warm_up_moto():
+    # moto imports its CloudFormation resource models on the first create_stack, keep
+    # that one-off cost (several seconds under tracemalloc) out of the measurements
+    boto3.client('cloudformation').create_stack(StackName='warm-up', TemplateBody=STUDENT_TEMPLATE,
+                                                Parameters=[{'ParameterKey': 'HostedZoneName',
+                                                             'ParameterValue': 'example.com'}])
+
+
+def set_handler_environment(students, mirror_dir, students_per_worker=0):
+    os.environ.update({
+        'LogLevel': os.getenv('BENCH_LOG_LEVEL', 'ERROR'),
+        'AuthBucket': AUTH_BUCKET,
+        'ClusterName': CLUSTER_NAME,
+        'NumStudents': str(students),
+        'HostedZoneName': 'example.com',
+        'OpenShiftMirrorURL': 'file://{}/'.format(mirror_dir),
+        'OpenShiftVersion': OPENSHIFT_VERSION,
+        'OpenShiftInstallBinary': 'openshift-install',
+        'CreateCloud9Instance': 'no',
+        'PullSecret': '{"auths": {}}',
+        'SSHKey': 'ssh-rsa AAAA benchmark',
+        'StudentsPerWorker': str(students_per_worker),
+        'ShardDispatch': 'local',
+    })
+
+
+def create_workshop_resources(students):
+    # What the master template creates before the StackDirector custom resource runs,
+    # returns the custom resource event
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=AUTH_BUCKET)
+    s3.create_bucket(Bucket=TEMPLATE_BUCKET)
+    s3.put_object(Bucket=TEMPLATE_BUCKET, Key='student.yaml', Body=STUDENT_TEMPLATE)
+    boto3.client('events').put_rule(Name=CLUSTER_NAME + '-ValidateEvent',
+                                    ScheduleExpression='rate(1 hour)')
+    return {'StackId': 'benchmark', 'RequestId': 'benchmark',
+            'LogicalResourceId': 'StudentStacksOCP4', 'ResponseURL': 'http://localhost/',
+            'ResourceProperties': {
+                'ServiceToken': 'benchmark',
+                'StackName': CLUSTER_NAME,
+                'NumStacks': str(students),
+                'TemplateURL': 'https://{}.s3.amazonaws.com/student.yaml'.format(TEMPLATE_BUCKET),
+                'HostedZoneName': 'example.com'}}
+
+
+def run_phase(event, api_calls, responses):
+    api_calls.clear()
+    FakeKubeAPI.requests.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    lambda_handler.handler(event, FakeContext())
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    status = responses[-1] if 'RequestType' in event and responses else '-'
+    return wall, sum(api_calls.values()), peak, status, dict(api_calls, **FakeKubeAPI.requests)
+
+
+def benchmark_handler(*student_counts):
+    from moto import mock_aws
+
+    student_counts = student_counts or (1, 10, 50, 100)
+    mirror_dir = tempfile.mkdtemp()
+    build_fake_mirror(mirror_dir)
+    kube_api = start_fake_kube_api()
+    scale_down = kube_scaler.scale_down
+    kube_scaler.scale_down = fake_scale_down(kube_api, scale_down)
+    os.chdir(SOURCE_DIR)
+    api_calls = Counter()
+    responses = []
+
+    def count_call(event_name, **kwargs):
+        api_calls[event_name.split('.', 1)[1]] += 1
+
+    get_client = lambda_handler.get_client
+
+    counted = set()
+    counted_lock = threading.Lock()
+
+    def counted_client(service):
+        # Worker threads race to create the shared clients, count each client once
+        client = get_client(service)
+        with counted_lock:
+            if id(client) not in counted:
+                counted.add(id(client))
+                client.meta.events.register('before-call.*.*', count_call)
+        return client
+
+    lambda_handler.get_client = counted_client
+    lambda_handler.probe_cluster = fake_probe_cluster
+    # The fake clusters are up as soon as their stacks are created
+    lambda_handler.VALIDATE_INSTALL_TIME = 0
+    cfnresponse.send = lambda event, context, status, *args, **kwargs: responses.append(status)
+
+    with mock_aws():
+        warm_up_moto()
+    print("{:>8} {:>9} {:>9} {:>10} {:>13} {:>8}".format(
+        "students", "phase", "wall (s)", "api calls", "peak mem (MB)", "result"))
+    try:
+        for students in student_counts:
+            set_handler_environment(students, mirror_dir)
+            with mock_aws():
+                reset_handler_state()
+                cfn_event = create_workshop_resources(students)
+                phases = [('Create', dict(cfn_event, RequestType='Create')),
+                          ('Validate', {}),
+                          ('Delete', dict(cfn_event, RequestType='Delete'))]
+                for phase, event in phases:
+                    wall, calls, peak, status, breakdown = run_phase(event, api_calls, responses)
+                    print("{:>8} {:>9} {:>9.2f} {:>10} {:>13.1f} {:>8}".format(
+                        students, phase, wall, calls, peak / 1024.0 / 1024.0, status))
+                    if os.getenv('BENCH_VERBOSE'):
+                        print("         {}".format(breakdown))
+    finally:
+        kube_api.shutdown()
+        kube_scaler.scale_down = scale_down
+        lambda_handler.get_client = get_client
+        shutil.rmtree(mirror_dir, ignore_errors=True)
+        reset_handler_state()
+    print("max rss: {:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def benchmark_shards(students=40, *students_per_worker):
+    """
+    Create and Delete of one class size, in a single invocation and split across
+    local worker processes. The workers share a moto server instead of in-process mocks.
+    "recorded" counts the students the state document knows as building after Create,
+    every worker writes to that one document.
+    """
+    from moto.server import ThreadedMotoServer
+
+    students_per_worker = students_per_worker or (0, 20, 10)
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    endpoint = 'http://127.0.0.1:{}'.format(port)
+    os.environ['AWS_ENDPOINT_URL'] = endpoint
+    mirror_dir = tempfile.mkdtemp()
+    build_fake_mirror(mirror_dir)
+    os.chdir(SOURCE_DIR)
+    responses = []
+    cfnresponse.send = lambda event, context, status, *args, **kwargs: responses.append(status)
+
+    print("{:>8} {:>8} {:>9} {:>9} {:>8} {:>9}".format("students", "workers", "phase", "wall (s)", "result", "recorded"))
+    try:
+        for per_worker in students_per_worker:
+            urllib.request.urlopen(urllib.request.Request(endpoint + '/moto-api/reset', method='POST'))
+            set_handler_environment(students, mirror_dir, per_worker)
+            reset_handler_state()
+            cfn_event = create_workshop_resources(students)
+            workers = -(-students // per_worker) if per_worker else 1
+            for phase in ('Create', 'Delete'):
+                del responses[:]
+                start = time.perf_counter()
+                lambda_handler.handler(dict(cfn_event, RequestType=phase), FakeContext())
+                elapsed = time.perf_counter() - start
+                recorded = '-'
+                if phase == 'Create':
+                    state = json.loads(boto3.client('s3').get_object(
+                        Bucket=AUTH_BUCKET, Key=lambda_handler.STATE_FILE)['Body'].read())
+                    recorded = sum(1 for student in state['students'].values() if student.get('status') == 'building')
+                print("{:>8} {:>8} {:>9} {:>9.2f} {:>8} {:>9}".format(
+                    students, workers, phase, elapsed, responses[-1] if responses else '-', recorded))
+    finally:
+        server.stop()
+        del os.environ['AWS_ENDPOINT_URL']
+        shutil.rmtree(mirror_dir, ignore_errors=True)
+        reset_handler_state()
+
+
+COLD_START = '''
+import json, sys, time
+start = time.perf_counter()
+import lambda_handler
+result = {"import": time.perf_counter() - start,
+          "loaded": [name for name in %r if name in sys.modules]}
+networks = {"clusterNetwork": "10.32.0.0/16", "serviceNetwork": "172.30.0.0/16"}
+for run in ("first", "warm"):
+    start = time.perf_counter()
+    lambda_handler.render_install_config("bench-student0", "ssh-rsa AAAA", "{}", "example.com", networks)
+    result[run + " install-config"] = time.perf_counter() - start
+    start = time.perf_counter()
+    lambda_handler.get_template("clusters.j2")
+    result[run + " template"] = time.perf_counter() - start
+print(json.dumps(result))
+'''
+# Only needed by the Create and Delete paths or once a cluster is ready to be scaled
+DEFERRED_MODULES = ['ruamel.yaml', 'jinja2', 'tarfile', 'subprocess', 'multiprocessing', 'kube_scaler']
+
+
+def benchmark_imports(iterations=10):
+    runs = []
+    for _ in range(iterations):
+        output = subprocess.run([sys.executable, '-c', COLD_START % DEFERRED_MODULES], cwd=SOURCE_DIR,
+                                check=True, stdout=subprocess.PIPE).stdout
+        runs.append(json.loads(output))
+    print("{} fresh interpreters, median".format(iterations))
+    for key in [key for key in runs[0] if key != "loaded"]:
+        print("  {:<22} {:>8.1f}ms".format(key, statistics.median(run[key] for run in runs) * 1000))
+    print("  loaded at import:      {}".format(", ".join(runs[0]["loaded"]) or "none of " + ", ".join(DEFERRED_MODULES)))
+
+
+BENCHMARKS = {
+    'clients': benchmark_clients,
+    'handler': benchmark_handler,
+    'shards': benchmark_shards,
+    'imports': benchmark_imports,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("usage: {} {{{}}} [args...]".format(sys.argv[0], ','.join(BENCHMARKS)))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])